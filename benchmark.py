@@ -0,0 +1,328 @@
+#! /usr/bin/python
+
+# benchmark - load generator for webcamd
+#
+# Opens N concurrent /?stream clients and M clients fetching /?snapshot in a loop, then reports
+# encode FPS, per-client stream FPS, end to end latency and webcamd's CPU / RSS usage.
+#
+# Use --launch to start fakeprinter.py and webcam.py locally, or --pid to measure an already
+# running webcamd.  Latency is measured from the timestamp fakeprinter.py stamps into each frame
+# (only preserved by passthrough streams) or from a non-zero X-Timestamp part header.
+#
+import os
+import sys
+import time
+import datetime
+import threading
+import socket
+import argparse
+import json
+import shlex
+import subprocess
+import urllib.request
+
+from urllib.parse import urlparse
+from fakeprinter import STAMP_PREFIX
+
+myargs = None
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+def percentile(values, fraction):
+    if len(values) == 0: return 0.
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def frameStamp(data, headers):
+    # fakeprinter.py puts a COM segment right after APP0
+    start = data.find(b"\xff\xfe", 0, 512)
+    if start != -1 and data[start + 4:start + 4 + len(STAMP_PREFIX)] == STAMP_PREFIX:
+        length = int.from_bytes(data[start + 2:start + 4], "big")
+        return float(data[start + 4 + len(STAMP_PREFIX):start + 2 + length])
+
+    stamp = float(headers.get("x-timestamp", 0))
+    return stamp if stamp > 0 else None
+
+class StreamClient(threading.Thread):
+    def __init__(self, url, deadline):
+        super().__init__(daemon=True)
+        self.url = urlparse(url)
+        self.deadline = deadline
+        self.frames = 0
+        self.bytes = 0
+        self.firstFrame = None
+        self.lastFrame = None
+        self.latencies = []
+        self.error = None
+
+    def run(self):
+        try:
+            with socket.create_connection((self.url.hostname, self.url.port or 80), timeout=10) as sock:
+                sock.sendall(b"GET %s?%s HTTP/1.0\r\nHost: %s\r\n\r\n" % (self.url.path.encode(), self.url.query.encode(), self.url.netloc.encode()))
+                f = sock.makefile("rb")
+
+                status = f.readline()
+                if b" 200 " not in status: raise Exception(status.decode("latin-1").strip())
+                while f.readline() not in (b"\r\n", b"\n", b""): pass
+
+                while time.time() < self.deadline:
+                    line = f.readline()
+                    if line == b"": raise Exception("stream closed by server")
+                    if not line.startswith(b"--boundarydonotcross"): continue
+
+                    headers = {}
+                    while True:
+                        line = f.readline().decode("latin-1").strip()
+                        if not line: break
+                        key, _, value = line.partition(":")
+                        headers[key.strip().lower()] = value.strip()
+
+                    data = f.read(int(headers["content-length"]))
+                    now = time.time()
+
+                    if self.firstFrame is None: self.firstFrame = now
+                    self.lastFrame = now
+                    self.frames = self.frames + 1
+                    self.bytes = self.bytes + len(data)
+
+                    stamp = frameStamp(data, headers)
+                    if stamp is not None: self.latencies.append(now - stamp)
+        except Exception as e:
+            self.error = str(e)
+
+    def getFps(self):
+        if self.frames < 2: return 0.
+        return (self.frames - 1) / (self.lastFrame - self.firstFrame)
+
+class SnapshotClient(threading.Thread):
+    def __init__(self, url, deadline):
+        super().__init__(daemon=True)
+        self.url = url
+        self.deadline = deadline
+        self.requests = 0
+        self.latencies = []
+        self.errors = 0
+
+    def run(self):
+        while time.time() < self.deadline:
+            start = time.time()
+            try:
+                with urllib.request.urlopen(self.url, timeout=10) as response:
+                    response.read()
+                self.requests = self.requests + 1
+                self.latencies.append(time.time() - start)
+            except Exception:
+                self.errors = self.errors + 1
+                time.sleep(.1)
+
+# samples CPU time and RSS of webcamd and its worker processes, and encode FPS from /?info
+class Sampler(threading.Thread):
+    def __init__(self, pid, infoUrl, deadline):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.infoUrl = infoUrl
+        self.deadline = deadline
+        self.startTicks = None
+        self.endTicks = None
+        self.startTime = None
+        self.endTime = None
+        self.rss = []
+        self.encodeFps = []
+
+    def processTree(self):
+        children = {}
+        for entry in os.listdir("/proc"):
+            if not entry.isdigit(): continue
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    fields = f.read().rpartition(")")[2].split()
+                children.setdefault(int(fields[1]), []).append(int(entry))
+            except OSError:
+                pass
+
+        tree = [self.pid]
+        for pid in tree: tree.extend(children.get(pid, []))
+        return tree
+
+    def sample(self):
+        ticks = 0
+        rss = 0
+        for pid in self.processTree():
+            try:
+                with open(f"/proc/{pid}/stat") as f:
+                    fields = f.read().rpartition(")")[2].split()
+            except OSError:
+                continue
+            # utime, stime (and cutime, cstime so exited workers still count)
+            ticks = ticks + sum(int(field) for field in fields[11:15])
+            rss = rss + int(fields[21]) * PAGE_SIZE
+        return ticks, rss
+
+    def run(self):
+        lastInfo = 0.
+        while time.time() < self.deadline:
+            if self.pid is not None:
+                ticks, rss = self.sample()
+                if self.startTicks is None:
+                    self.startTicks = ticks
+                    self.startTime = time.time()
+                self.endTicks = ticks
+                self.endTime = time.time()
+                self.rss.append(rss)
+
+            # webcamd recalculates encode fps every 5 seconds
+            if time.time() > lastInfo + 5:
+                lastInfo = time.time()
+                try:
+                    with urllib.request.urlopen(self.infoUrl, timeout=5) as response:
+                        fps = json.loads(response.read())["stats"]["encodeFps"]
+                    if fps > 0: self.encodeFps.append(fps)
+                except Exception:
+                    pass
+
+            time.sleep(1.)
+
+    def getCpu(self):
+        if self.startTicks is None or self.endTime <= self.startTime: return None
+        return (self.endTicks - self.startTicks) / CLOCK_TICKS / (self.endTime - self.startTime) * 100.
+
+def waitForServer(url, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(url + "?snapshot", timeout=5) as response:
+                if response.status == 200: return True
+        except Exception:
+            pass
+        time.sleep(.5)
+    return False
+
+def launch():
+    directory = os.path.dirname(os.path.abspath(__file__))
+    port = urlparse(myargs.url).port or 80
+
+    printer = subprocess.Popen([sys.executable, os.path.join(directory, "fakeprinter.py"), "--frames", myargs.launch, "--fps", str(myargs.fps),
+                                "--password", "benchmark"], stdout=subprocess.DEVNULL)
+    # give the printer time to generate its certificate
+    time.sleep(2)
+    webcamd = subprocess.Popen([sys.executable, os.path.join(directory, "webcam.py"), "--hostname", "127.0.0.1", "--password", "benchmark",
+                                "--port", str(port)] + shlex.split(myargs.webcamargs), stdout=subprocess.DEVNULL)
+    return printer, webcamd
+
+def report(streams, snapshots, sampler):
+    fps = [client.getFps() for client in streams]
+    latencies = [latency for client in streams for latency in client.latencies]
+    snapshotLatencies = [latency for client in snapshots for latency in client.latencies]
+    cpu = sampler.getCpu()
+
+    results = {
+        "streams": len(streams),
+        "snapshotClients": len(snapshots),
+        "duration": myargs.duration,
+        "encodeFps": sum(sampler.encodeFps) / len(sampler.encodeFps) if sampler.encodeFps else 0.,
+        "streamFps": {"min": min(fps, default=0.), "avg": sum(fps) / len(fps) if fps else 0., "max": max(fps, default=0.)},
+        "streamBytes": sum(client.bytes for client in streams),
+        "latencyMs": {"samples": len(latencies), "p50": percentile(latencies, .5) * 1000, "p95": percentile(latencies, .95) * 1000, "max": max(latencies, default=0.) * 1000},
+        "snapshots": {"requests": sum(client.requests for client in snapshots), "perSecond": sum(client.requests for client in snapshots) / myargs.duration,
+                      "p50Ms": percentile(snapshotLatencies, .5) * 1000, "p95Ms": percentile(snapshotLatencies, .95) * 1000},
+        "cpuPercent": cpu,
+        "rssMb": {"avg": sum(sampler.rss) / len(sampler.rss) / 1048576 if sampler.rss else None, "peak": max(sampler.rss) / 1048576 if sampler.rss else None},
+        "errors": [client.error for client in streams if client.error is not None] + ["snapshot failed"] * sum(client.errors for client in snapshots),
+    }
+
+    if myargs.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"webcamd benchmark - {len(streams)} streams, {len(snapshots)} snapshot clients, {myargs.duration}s against {myargs.url}")
+    print(f"encode fps         : {results['encodeFps']:.2f}")
+    print(f"stream fps         : min {results['streamFps']['min']:.2f} / avg {results['streamFps']['avg']:.2f} / max {results['streamFps']['max']:.2f} per client")
+    print(f"stream throughput  : {results['streamBytes'] / myargs.duration / 1048576:.2f} MB/s")
+    if latencies:
+        print(f"stream latency     : p50 {results['latencyMs']['p50']:.1f}ms / p95 {results['latencyMs']['p95']:.1f}ms / max {results['latencyMs']['max']:.1f}ms ({len(latencies)} frames)")
+    else:
+        print("stream latency     : n/a - frames carry no timestamp (transformed stream or a real printer)")
+    if snapshots:
+        print(f"snapshots          : {results['snapshots']['perSecond']:.2f}/s - p50 {results['snapshots']['p50Ms']:.1f}ms / p95 {results['snapshots']['p95Ms']:.1f}ms")
+    if cpu is not None:
+        print(f"webcamd cpu        : {cpu:.1f}% of one core")
+        print(f"webcamd rss        : avg {results['rssMb']['avg']:.1f}MB / peak {results['rssMb']['peak']:.1f}MB")
+    else:
+        print("webcamd cpu / rss  : n/a - use --pid or --launch")
+    print(f"errors             : {len(results['errors'])}")
+    for error in sorted(set(results["errors"])): print(f"  {error}")
+
+def main():
+    global myargs
+
+    parseArgs()
+
+    processes = []
+    pid = myargs.pid
+
+    if myargs.launch is not None:
+        processes = launch()
+        pid = processes[1].pid
+
+    try:
+        if not waitForServer(myargs.url, 30):
+            print(f"{datetime.datetime.now()}: webcamd at {myargs.url} is not serving snapshots", file=sys.stderr, flush=True)
+            sys.exit(os.EX_UNAVAILABLE)
+
+        deadline = time.time() + myargs.duration
+        streams = [StreamClient(myargs.url + "?stream" + myargs.query, deadline) for i in range(myargs.streams)]
+        snapshots = [SnapshotClient(myargs.url + "?snapshot" + myargs.query, deadline) for i in range(myargs.snapshots)]
+        sampler = Sampler(pid, myargs.url + "?info", deadline)
+
+        print(f"{datetime.datetime.now()}: running for {myargs.duration} seconds", file=sys.stderr, flush=True)
+        for client in streams + snapshots + [sampler]: client.start()
+        for client in streams + snapshots + [sampler]: client.join(myargs.duration + 15)
+
+        report(streams, snapshots, sampler)
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            process.wait()
+
+def parseArgs():
+    global myargs
+
+    parser = argparse.ArgumentParser(
+        description="benchmark.py - load generator for webcamd"
+    )
+    parser.add_argument(
+        "--url", type=str, default="http://127.0.0.1:8080/", help="webcamd camera url, e.g. http://host:8080/cam/x1c/ (default 'http://127.0.0.1:8080/')"
+    )
+    parser.add_argument(
+        "--streams", type=int, default=10, help="concurrent /?stream clients (default 10)"
+    )
+    parser.add_argument(
+        "--snapshots", type=int, default=0, help="clients requesting /?snapshot back to back (default 0)"
+    )
+    parser.add_argument(
+        "--duration", type=int, default=30, help="seconds to run (default 30)"
+    )
+    parser.add_argument(
+        "--query", type=str, default="", help="extra query string for every request, e.g. '&rotate=90&width=640' (default none)"
+    )
+    parser.add_argument(
+        "--pid", type=int, help="pid of a running webcamd to measure CPU / RSS for"
+    )
+    parser.add_argument(
+        "--launch", type=str, metavar="FRAMES", help="start fakeprinter.py replaying this jpeg directory and webcam.py, measure them and stop them afterwards"
+    )
+    parser.add_argument(
+        "--fps", type=float, default=15., help="fakeprinter.py frame rate with --launch (default 15)"
+    )
+    parser.add_argument(
+        "--webcamargs", type=str, default="", help="extra webcam.py arguments with --launch, e.g. '--passthrough --encodewait 0' (default none)"
+    )
+    parser.add_argument('--json', action='store_true', help="print the results as json (default false)")
+
+    myargs = parser.parse_args()
+
+    if not myargs.url.endswith("/"): myargs.url = myargs.url + "/"
+
+if __name__ == "__main__":
+    main()
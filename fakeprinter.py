@@ -0,0 +1,183 @@
+#! /usr/bin/python
+
+# fakeprinter - a stand-in for the Bambu printer camera used to benchmark and test webcamd
+#
+# Speaks the same protocol webcam.py expects on port 6000: TLS, an 80 byte auth blob, then a
+# 16 byte header (little endian payload size) followed by each jpeg.  Frames are replayed from
+# a directory in name order at a fixed rate.
+#
+# Each frame is stamped with a jpeg comment holding the time it was sent so benchmark.py can
+# measure end to end latency on passthrough streams.
+#
+import os
+import sys
+import time
+import datetime
+import threading
+import socket
+import argparse
+import glob
+import struct
+import ssl
+import subprocess
+import tempfile
+
+myargs = None
+frames = []
+
+USERNAME = 'bblp'
+AUTH_SIZE = 80
+STAMP_PREFIX = b"fakeprinter "
+
+def loadFrames(directory):
+    loaded = []
+    for path in sorted(glob.glob(os.path.join(directory, "*.jpg")) + glob.glob(os.path.join(directory, "*.jpeg"))):
+        with open(path, "rb") as f:
+            data = f.read()
+        # webcam.py discards frames that don't start with SOI + APP0 (JFIF)
+        if data[:4] != b"\xff\xd8\xff\xe0" or data[-2:] != b"\xff\xd9":
+            print(f"{datetime.datetime.now()}: skipping {path} - not a JFIF jpeg", flush=True)
+            continue
+        loaded.append(data)
+    return loaded
+
+# insert a COM segment with the send time straight after the APP0 segment
+def stampFrame(data, now):
+    offset = 4 + struct.unpack(">H", data[4:6])[0]
+    comment = STAMP_PREFIX + b"%.6f" % now
+    return data[:offset] + b"\xff\xfe" + struct.pack(">H", len(comment) + 2) + comment + data[offset:]
+
+def parseAuth(auth):
+    username = auth[16:48].rstrip(b"\0").decode("ascii", "replace")
+    password = auth[48:80].rstrip(b"\0").decode("ascii", "replace")
+    return username, password
+
+def createContext():
+    certfile = myargs.certfile
+    keyfile = myargs.keyfile
+
+    if certfile is None:
+        # printers use a self signed certificate and webcam.py does not verify it, so make one up
+        directory = tempfile.mkdtemp(prefix="fakeprinter")
+        certfile = os.path.join(directory, "cert.pem")
+        keyfile = os.path.join(directory, "key.pem")
+        subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "365",
+                        "-subj", "/CN=fakeprinter", "-keyout", keyfile, "-out", certfile],
+                       check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        print(f"{datetime.datetime.now()}: generated self signed certificate {certfile}", flush=True)
+
+    ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    ctx.load_cert_chain(certfile, keyfile)
+    return ctx
+
+def serveClient(ctx, sock, address):
+    client = "%s:%d" % address[:2]
+
+    try:
+        with ctx.wrap_socket(sock, server_side=True) as sslSock:
+            auth = b""
+            while len(auth) < AUTH_SIZE:
+                chunk = sslSock.recv(AUTH_SIZE - len(auth))
+                if not chunk: return
+                auth += chunk
+
+            username, password = parseAuth(auth)
+            if username != USERNAME or (myargs.password is not None and password != myargs.password):
+                # like a real printer, close without sending anything
+                print(f"{datetime.datetime.now()}: {client}: rejected credentials for {username}", flush=True)
+                return
+
+            print(f"{datetime.datetime.now()}: {client}: connected", flush=True)
+
+            interval = 1. / myargs.fps
+            nextFrame = time.monotonic()
+            index = 0
+            sent = 0
+
+            while myargs.count == 0 or sent < myargs.count:
+                data = frames[index % len(frames)]
+                if not myargs.nostamp: data = stampFrame(data, time.time())
+                sslSock.sendall(struct.pack("<IIII", len(data), 0, 1, 0) + data)
+                index = index + 1
+                sent = sent + 1
+
+                nextFrame = nextFrame + interval
+                delay = nextFrame - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    # fell behind - don't try to catch up with a burst
+                    nextFrame = time.monotonic()
+
+            if myargs.count > 0: print(f"{datetime.datetime.now()}: {client}: dropping connection after {sent} frames", flush=True)
+    except (ConnectionError, ssl.SSLError, OSError) as e:
+        print(f"{datetime.datetime.now()}: {client}: disconnected: [{e}]", flush=True)
+        return
+
+    print(f"{datetime.datetime.now()}: {client}: done", flush=True)
+
+def main():
+    global myargs
+    global frames
+
+    parseArgs()
+
+    frames = loadFrames(myargs.frames)
+    if len(frames) == 0:
+        print(f"{datetime.datetime.now()}: no jpeg frames found in {myargs.frames}", flush=True)
+        sys.exit(os.EX_NOINPUT)
+
+    ctx = createContext()
+
+    server = socket.create_server((myargs.bindaddress, myargs.port), reuse_port=True)
+    print(f"{datetime.datetime.now()}: replaying {len(frames)} frames @ {myargs.fps} FPS on {myargs.bindaddress}:{myargs.port}", flush=True)
+
+    try:
+        while True:
+            sock, address = server.accept()
+            threading.Thread(target=serveClient, args=(ctx, sock, address), daemon=True).start()
+    except KeyboardInterrupt:
+        pass
+
+    server.close()
+    print(f"{datetime.datetime.now()}: Goodbye!", flush=True)
+
+def parseArgs():
+    global myargs
+
+    parser = argparse.ArgumentParser(
+        description="fakeprinter.py - replays jpegs using the Bambu printer camera protocol"
+    )
+    parser.add_argument(
+        "--frames", type=str, required=True, help="directory of JFIF jpegs to replay in name order"
+    )
+    parser.add_argument(
+        "--fps", type=float, default=15., help="frames per second to send (default 15)"
+    )
+    parser.add_argument(
+        "--bindaddress", type=str, default="127.0.0.1", help="bind address - use 127.0.0.2, 127.0.0.3, ... to run several printers (default '127.0.0.1')"
+    )
+    parser.add_argument(
+        "--port", type=int, default=6000, help="bind port (default 6000)"
+    )
+    parser.add_argument(
+        "--password", type=str, help="access code clients must send (default accept any)"
+    )
+    parser.add_argument(
+        "--certfile", type=str, help="TLS certificate (default generate a self signed certificate with openssl)"
+    )
+    parser.add_argument(
+        "--keyfile", type=str, help="TLS private key for --certfile"
+    )
+    parser.add_argument(
+        "--count", type=int, default=0, help="frames to send before dropping the connection - simulates printer disconnects (default 0 - never)"
+    )
+    parser.add_argument('--nostamp', action='store_true', help="send frames unmodified instead of adding a timestamp comment (default false)")
+
+    myargs = parser.parse_args()
+
+    if myargs.fps <= 0: parser.error("--fps must be positive")
+    if myargs.certfile is not None and myargs.keyfile is None: myargs.keyfile = myargs.certfile
+
+if __name__ == "__main__":
+    main()
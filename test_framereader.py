@@ -0,0 +1,110 @@
+#! /usr/bin/python
+
+# regression checks for webcam.py's FrameReader - run with: python -m unittest test_framereader
+#
+# The printer's 16 byte headers and jpeg payloads arrive in arbitrary TLS record sizes, so a header
+# can be split across reads or share a read with the end of the previous payload.
+#
+import socket
+import ssl
+import struct
+import unittest
+
+from webcam import FrameReader, FrameError
+
+def packFrame(data):
+    return struct.pack("<IIII", len(data), 0, 1, 0) + data
+
+# stands in for the non-blocking TLS socket - hands out the scripted chunks, then reports SSLWantReadError
+class ChunkedSocket:
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+        # something real for the selector to wait on - it never becomes readable
+        self.idle, self.peer = socket.socketpair()
+
+    def fileno(self):
+        return self.idle.fileno()
+
+    def recv_into(self, view):
+        if not self.chunks: raise ssl.SSLWantReadError()
+        chunk = self.chunks.pop(0)
+        if chunk is None: return 0
+        count = min(len(chunk), len(view))
+        view[:count] = chunk[:count]
+        if count < len(chunk): self.chunks.insert(0, chunk[count:])
+        return count
+
+    def close(self):
+        self.idle.close()
+        self.peer.close()
+
+def split(data, sizes):
+    chunks = []
+    offset = 0
+    index = 0
+    while offset < len(data):
+        size = sizes[index % len(sizes)]
+        chunks.append(data[offset:offset + size])
+        offset += size
+        index += 1
+    return chunks
+
+class FrameReaderTest(unittest.TestCase):
+    FRAMES = [b"\xff\xd8\xff\xe0" + bytes([n]) * (100 + n * 37) + b"\xff\xd9" for n in range(5)]
+
+    def readAll(self, chunks, count):
+        sock = ChunkedSocket(chunks)
+        try:
+            with FrameReader(sock) as reader:
+                frames = [bytes(reader.readFrame(1)) for _ in range(count)]
+                self.assertIsNone(reader.readFrame(0))
+                return frames
+        finally:
+            sock.close()
+
+    def test_whole_frames(self):
+        self.assertEqual(self.readAll([packFrame(f) for f in self.FRAMES], len(self.FRAMES)), self.FRAMES)
+
+    def test_split_headers(self):
+        for sizes in ([1], [3], [7, 9], [15, 2], [16], [17, 5]):
+            stream = b"".join(packFrame(f) for f in self.FRAMES)
+            self.assertEqual(self.readAll(split(stream, sizes), len(self.FRAMES)), self.FRAMES, sizes)
+
+    def test_coalesced_frames(self):
+        # several headers and payloads in one read, with the last header cut in half
+        stream = b"".join(packFrame(f) for f in self.FRAMES)
+        cut = len(stream) - len(packFrame(self.FRAMES[-1])) + 8
+        self.assertEqual(self.readAll([stream[:cut], stream[cut:]], len(self.FRAMES)), self.FRAMES)
+
+    def test_incomplete_frame(self):
+        stream = packFrame(self.FRAMES[0])
+        sock = ChunkedSocket([stream[:10]])
+        try:
+            with FrameReader(sock) as reader:
+                self.assertIsNone(reader.readFrame(0))
+                sock.chunks.append(stream[10:])
+                self.assertEqual(bytes(reader.readFrame(1)), self.FRAMES[0])
+        finally:
+            sock.close()
+
+    def test_hang_up(self):
+        sock = ChunkedSocket([packFrame(self.FRAMES[0])[:20], None])
+        try:
+            with FrameReader(sock) as reader:
+                with self.assertRaises(EOFError):
+                    reader.readFrame(1)
+        finally:
+            sock.close()
+
+    def test_invalid_size(self):
+        for size in (0, FrameReader.MAX_PAYLOAD_SIZE + 1):
+            sock = ChunkedSocket([struct.pack("<IIII", size, 0, 1, 0)])
+            try:
+                with FrameReader(sock) as reader:
+                    with self.assertRaises(FrameError):
+                        reader.readFrame(1)
+            finally:
+                sock.close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+#! /usr/bin/python
+
+# regression checks for webcam.py's shared memory FrameRing - run with: python -m unittest test_framering
+#
+# Readers in other processes (and --workers) parse the header and slots themselves, so the byte layout is
+# part of the interface.  A reader holding a zero copy view must be able to tell when the writer has since
+# reused those bytes.
+#
+import os
+import struct
+import tempfile
+import unittest
+
+from webcam import FrameRing, RING_MAGIC, RING_HEADER, RING_HEADER_SIZE, RING_SLOT, NOTIFY_MESSAGE
+
+class FrameRingTest(unittest.TestCase):
+    DATA_SIZE = 1000
+    SLOTS = 4
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "webcamd-test")
+        self.writer = FrameRing(self.path, self.DATA_SIZE, self.SLOTS, create=True)
+        self.reader = FrameRing(self.path)
+
+    def tearDown(self):
+        self.reader.close()
+        self.writer.close(unlink=True)
+        self.directory.cleanup()
+
+    def raw(self):
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def test_layout(self):
+        self.assertEqual(RING_HEADER.size, 48)
+        self.assertEqual(RING_SLOT.size, 32)
+        self.assertEqual(NOTIFY_MESSAGE.size, 28)
+
+        raw = self.raw()
+        self.assertEqual(len(raw), RING_HEADER_SIZE + self.SLOTS * RING_SLOT.size + self.DATA_SIZE)
+        self.assertEqual(struct.unpack_from("<8sIIQQQQ", raw, 0), (RING_MAGIC, 1, self.SLOTS, self.DATA_SIZE, 0, 0, 0))
+        self.assertEqual((self.reader.slots, self.reader.dataSize), (self.SLOTS, self.DATA_SIZE))
+
+        position = self.writer.publish(1, 12.5, b"a" * 100)
+        position = self.writer.publish(2, 13.5, b"b" * 200)
+        self.assertEqual(position, 100)
+
+        raw = self.raw()
+        # latest seq at 24, reserved at 32, committed at 40
+        self.assertEqual(struct.unpack_from("<QQQ", raw, 24), (2, 300, 300))
+        # seq 2 lives in slot 2 % slots
+        self.assertEqual(struct.unpack_from("<QdQI", raw, RING_HEADER_SIZE + 2 * RING_SLOT.size), (2, 13.5, 100, 200))
+        dataStart = RING_HEADER_SIZE + self.SLOTS * RING_SLOT.size
+        self.assertEqual(raw[dataStart + 100:dataStart + 300], b"b" * 200)
+
+    def test_round_trip(self):
+        self.assertIsNone(self.reader.copy(1))
+        self.writer.publish(1, 1.25, b"first")
+        self.writer.publish(2, 2.25, b"second")
+        self.assertEqual(self.reader.latest(), 2)
+        self.assertEqual(self.reader.copy(1), (1.25, b"first"))
+        self.assertEqual(self.reader.copy(2), (2.25, b"second"))
+        self.assertIsNone(self.reader.copy(0))
+
+    def test_wraps_instead_of_splitting(self):
+        self.writer.publish(1, 1., b"x" * 700)
+        # 400 bytes don't fit behind the first frame, so the second starts over at the next multiple of data size
+        self.assertEqual(self.writer.publish(2, 2., b"y" * 400), self.DATA_SIZE)
+        self.assertEqual(self.reader.copy(2), (2., b"y" * 400))
+        self.assertIsNone(self.reader.copy(1))
+
+    def test_slot_reuse(self):
+        for seq in range(1, self.SLOTS + 2):
+            self.writer.publish(seq, float(seq), bytes([seq]) * 10)
+        # seq 1 and seq 1 + slots share a slot
+        self.assertIsNone(self.reader.copy(1))
+        self.assertEqual(self.reader.copy(self.SLOTS + 1), (float(self.SLOTS + 1), bytes([self.SLOTS + 1]) * 10))
+
+    def test_torn_read(self):
+        self.writer.publish(1, 1., b"a" * 600)
+        timestamp, position, view = self.reader.frame(1)
+        self.assertTrue(self.reader.valid(position))
+
+        # the next frame wraps and reserves the bytes the view still points at
+        self.writer.publish(2, 2., b"b" * 600)
+        self.assertFalse(self.reader.valid(position))
+        view.release()
+        self.assertIsNone(self.reader.copy(1))
+
+    def test_oversized_frame(self):
+        with self.assertRaises(ValueError):
+            self.writer.publish(1, 1., b"z" * (self.DATA_SIZE + 1))
+        self.assertEqual(self.reader.latest(), 0)
+
+    def test_not_a_ring(self):
+        path = os.path.join(self.directory.name, "other")
+        with open(path, "wb") as f:
+            f.write(b"\0" * 128)
+        with self.assertRaises(ValueError):
+            FrameRing(path)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,102 @@
+#! /usr/bin/python
+
+# regression checks for webcam.py's recorded segments - run with: python -m unittest test_recording
+#
+# ?recording&time= seeks with a hand written binary search over the mmapped index (bisect only takes a
+# key= from 3.10 on), so repeated timestamps and times outside the segment have to land on the right frame.
+#
+import os
+import time
+import tempfile
+import unittest
+
+from webcam import Segment, Recorder, INDEX_RECORD, segmentTime
+
+# a segment as the Recorder leaves it - concatenated jpegs plus a (timestamp, offset, length) record each
+def writeSegment(directory, name, timestamps):
+    frames = []
+    offset = 0
+    with open(os.path.join(directory, name + ".mjpeg"), "wb") as data, open(os.path.join(directory, name + ".idx"), "wb") as index:
+        for number, timestamp in enumerate(timestamps):
+            frame = b"\xff\xd8" + bytes([number]) * (10 + number) + b"\xff\xd9"
+            data.write(frame)
+            index.write(INDEX_RECORD.pack(timestamp, offset, len(frame)))
+            offset = offset + len(frame)
+            frames.append(frame)
+    return frames
+
+class SegmentTest(unittest.TestCase):
+    TIMESTAMPS = [10., 11., 11., 12.5, 20.]
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.frames = writeSegment(self.directory.name, "20240101-120000", self.TIMESTAMPS)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def segment(self, name="20240101-120000"):
+        return Segment(self.directory.name, name)
+
+    def test_locate_time(self):
+        with self.segment() as segment:
+            for at, index in ((5., 0), (10., 0), (10.5, 0), (11., 2), (12., 2), (12.5, 3), (19.999, 3), (20., 4), (99., 4)):
+                self.assertEqual(segment.locate(at=at), index, at)
+
+    def test_locate_time_every_length(self):
+        # odd and even lengths walk different paths through the search
+        for count in range(1, 9):
+            writeSegment(self.directory.name, "20240101-130000", [float(n) for n in range(count)])
+            with self.segment("20240101-130000") as segment:
+                for n in range(count):
+                    self.assertEqual(segment.locate(at=n + .5), n, (count, n))
+                self.assertEqual(segment.locate(at=-1.), 0, count)
+
+    def test_locate_frame(self):
+        with self.segment() as segment:
+            self.assertEqual(segment.locate(), 0)
+            self.assertEqual(segment.locate(3), 3)
+            self.assertEqual(segment.locate(-1), 4)
+            self.assertEqual(segment.locate(-99), 0)
+            self.assertEqual(segment.locate(99), 4)
+
+    def test_read(self):
+        with self.segment() as segment:
+            self.assertEqual(segment.frames, len(self.TIMESTAMPS))
+            self.assertEqual(segment.length, sum(len(frame) for frame in self.frames))
+            for index, frame in enumerate(self.frames):
+                self.assertEqual(segment.read(index), (self.TIMESTAMPS[index], frame))
+            self.assertEqual(segment.summary(), {"name": "20240101-120000", "start": 10., "end": 20., "frames": 5, "bytes": segment.length})
+
+    def test_empty(self):
+        writeSegment(self.directory.name, "20240101-130000", [])
+        with self.segment("20240101-130000") as segment:
+            self.assertIsNone(segment.locate())
+            self.assertIsNone(segment.locate(at=10.))
+            self.assertEqual(segment.summary()["frames"], 0)
+
+    def test_partial_index_record(self):
+        # the recorder was stopped half way through an index write
+        with open(os.path.join(self.directory.name, "20240101-120000.idx"), "ab") as index:
+            index.write(b"\0" * (INDEX_RECORD.size // 2))
+        with self.segment() as segment:
+            self.assertEqual(segment.frames, len(self.TIMESTAMPS))
+            self.assertEqual(segment.locate(at=99.), 4)
+
+    def test_find_segment(self):
+        writeSegment(self.directory.name, "20240101-130000", [1.])
+        writeSegment(self.directory.name, "20240101-130000-1", [2.])
+        recorder = Recorder.__new__(Recorder)
+        recorder.directory = self.directory.name
+        self.assertEqual(recorder.segments(), ["20240101-120000", "20240101-130000", "20240101-130000-1"])
+
+        at = segmentTime("20240101-123000")
+        self.assertEqual(recorder.findSegment(at=at).name, "20240101-120000")
+        self.assertEqual(recorder.findSegment().name, "20240101-130000-1")
+        self.assertEqual(recorder.findSegment(name="20240101-130000").name, "20240101-130000")
+        self.assertIsNone(recorder.findSegment(name="../20240101-130000"))
+        self.assertIsNone(recorder.findSegment(at=segmentTime("20231231-235959")))
+        self.assertEqual(segmentTime("20240101-120000-3"), time.mktime((2024, 1, 1, 12, 0, 0, 0, 0, -1)))
+
+if __name__ == "__main__":
+    unittest.main()
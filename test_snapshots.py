@@ -0,0 +1,66 @@
+#! /usr/bin/python
+
+# regression checks for webcam.py's conditional ?snapshot requests - run with: python -m unittest test_snapshots
+#
+# A poller that sends back the ETag or Last-Modified it got gets a 304 until a new frame arrives.  The
+# threaded front-end hands over an email.message.Message, the asyncio one a dict with lower case names.
+#
+import io
+import http.client
+import unittest
+from email.utils import formatdate
+
+import webcam
+from webcam import Frame, notModified, snapshotValidators
+
+def messageHeaders(headers):
+    return http.client.parse_headers(io.BytesIO("".join("%s: %s\r\n" % header for header in headers.items()).encode() + b"\r\n"))
+
+class SnapshotTest(unittest.TestCase):
+    TIMESTAMP = 1700000000.75
+
+    def setUp(self):
+        self.frame = Frame(b"\xff\xd8\xff\xd9", 42, timestamp=self.TIMESTAMP)
+        self.etag, self.lastModified = snapshotValidators(self.frame)
+
+    def check(self, headers, expected):
+        self.assertEqual(notModified({name.lower(): value for name, value in headers.items()}, self.frame, self.etag), expected, headers)
+        self.assertEqual(notModified(messageHeaders(headers), self.frame, self.etag), expected, headers)
+
+    def test_validators(self):
+        self.assertEqual(self.etag, '"%s-42"' % webcam.SNAPSHOT_TAG)
+        self.assertEqual(self.lastModified, "Tue, 14 Nov 2023 22:13:20 GMT")
+        # a new frame is a new tag even within the same second
+        self.assertNotEqual(snapshotValidators(Frame(b"", 43, timestamp=self.TIMESTAMP))[0], self.etag)
+
+    def test_no_validators(self):
+        self.check({}, False)
+
+    def test_if_none_match(self):
+        self.check({"If-None-Match": self.etag}, True)
+        self.check({"If-None-Match": "W/" + self.etag}, True)
+        self.check({"If-None-Match": '"other", %s' % self.etag}, True)
+        self.check({"If-None-Match": '"other",%s ' % self.etag}, True)
+        self.check({"If-None-Match": "*"}, True)
+        self.check({"If-None-Match": '"%s-41"' % webcam.SNAPSHOT_TAG}, False)
+        # the tag of another server instance, or one without its quotes
+        self.check({"If-None-Match": '"0-42"'}, False)
+        self.check({"If-None-Match": self.etag.strip('"')}, False)
+        self.check({"If-None-Match": ""}, False)
+
+    def test_if_none_match_wins(self):
+        # RFC 9110 - If-Modified-Since is ignored when If-None-Match is present
+        self.check({"If-None-Match": '"other"', "If-Modified-Since": self.lastModified}, False)
+        self.check({"If-None-Match": self.etag, "If-Modified-Since": formatdate(0, usegmt=True)}, True)
+
+    def test_if_modified_since(self):
+        self.check({"If-Modified-Since": self.lastModified}, True)
+        self.check({"If-Modified-Since": formatdate(self.TIMESTAMP + 60, usegmt=True)}, True)
+        self.check({"If-Modified-Since": formatdate(self.TIMESTAMP - 1, usegmt=True)}, False)
+
+    def test_bad_date(self):
+        for since in ("yesterday", "", "Tue, 99 Nov 2023 22:13:20 GMT"):
+            self.check({"If-Modified-Since": since}, False)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,152 @@
+#! /usr/bin/python
+
+# regression checks for webcam.py's ?ws websocket framing - run with: python -m unittest test_websocket
+#
+# Browsers mask every client frame and send acks, pings and closes between our binary frames, so both
+# front-ends have to parse them, answer pings with the same payload and echo closes.
+#
+import os
+import io
+import socket
+import struct
+import asyncio
+import unittest
+
+from webcam import (WebRequestHandler, AsyncRequestHandler, websocketAccept, websocketHeader, websocketUnmask, readWebSocketMessage,
+                    readWebSocketMessageAsync, WEBSOCKET_TEXT, WEBSOCKET_BINARY, WEBSOCKET_CLOSE, WEBSOCKET_PING, WEBSOCKET_PONG,
+                    MAX_WEBSOCKET_MESSAGE)
+
+# a client frame as a browser sends it - always masked
+def clientFrame(opcode, payload, mask=None):
+    if mask is None: mask = os.urandom(4)
+    masked = bytes(byte ^ mask[index % 4] for index, byte in enumerate(payload))
+    if len(payload) < 126:
+        header = struct.pack(">BB", 0x80 | opcode, 0x80 | len(payload))
+    elif len(payload) < 65536:
+        header = struct.pack(">BBH", 0x80 | opcode, 0x80 | 126, len(payload))
+    else:
+        header = struct.pack(">BBQ", 0x80 | opcode, 0x80 | 127, len(payload))
+    return header + mask + masked
+
+# whole server frames back out of what a handler wrote
+def serverFrames(data):
+    frames = []
+    while data:
+        opcode, length = data[0] & 0x0f, data[1] & 0x7f
+        start = 2
+        if length == 126: length, start = struct.unpack_from(">H", data, 2)[0], 4
+        elif length == 127: length, start = struct.unpack_from(">Q", data, 2)[0], 10
+        frames.append((opcode, data[start:start + length]))
+        data = data[start + length:]
+    return frames
+
+class FramingTest(unittest.TestCase):
+    def test_accept(self):
+        # the example handshake from RFC 6455
+        self.assertEqual(websocketAccept("dGhlIHNhbXBsZSBub25jZQ=="), "s3pPLMBiTxaQ9kYGzzhZRbK+xOo=")
+
+    def test_header(self):
+        self.assertEqual(websocketHeader(WEBSOCKET_BINARY, 125), b"\x82\x7d")
+        self.assertEqual(websocketHeader(WEBSOCKET_BINARY, 126), b"\x82\x7e\x00\x7e")
+        self.assertEqual(websocketHeader(WEBSOCKET_BINARY, 65535), b"\x82\x7e\xff\xff")
+        self.assertEqual(websocketHeader(WEBSOCKET_BINARY, 65536), b"\x82\x7f" + struct.pack(">Q", 65536))
+        self.assertEqual(websocketHeader(WEBSOCKET_CLOSE, 0), b"\x88\x00")
+
+    def test_unmask(self):
+        mask = b"\x37\xfa\x21\x3d"
+        # the masked "Hello" from RFC 6455
+        self.assertEqual(websocketUnmask(mask, b"\x7f\x9f\x4d\x51\x58"), b"Hello")
+        self.assertEqual(websocketUnmask(b"", b"plain"), b"plain")
+        self.assertEqual(websocketUnmask(mask, b""), b"")
+        payload = os.urandom(1001)
+        self.assertEqual(websocketUnmask(mask, websocketUnmask(mask, payload)), payload)
+
+    def test_read(self):
+        for opcode, payload in ((WEBSOCKET_TEXT, b"ack"), (WEBSOCKET_PING, b""), (WEBSOCKET_BINARY, os.urandom(300)),
+                                (WEBSOCKET_TEXT, os.urandom(MAX_WEBSOCKET_MESSAGE))):
+            self.assertEqual(readWebSocketMessage(io.BytesIO(clientFrame(opcode, payload)).read), (opcode, payload))
+
+    def test_read_unmasked(self):
+        self.assertEqual(readWebSocketMessage(io.BytesIO(b"\x81\x03ack").read), (WEBSOCKET_TEXT, b"ack"))
+
+    def test_read_oversized(self):
+        frame = clientFrame(WEBSOCKET_BINARY, b"x" * (MAX_WEBSOCKET_MESSAGE + 1))
+        self.assertEqual(readWebSocketMessage(io.BytesIO(frame).read), (WEBSOCKET_CLOSE, b""))
+
+    def test_read_hang_up(self):
+        self.assertEqual(readWebSocketMessage(io.BytesIO(b"").read), (WEBSOCKET_CLOSE, b""))
+        self.assertEqual(readWebSocketMessage(io.BytesIO(b"\x81").read), (WEBSOCKET_CLOSE, b""))
+
+    def test_read_async(self):
+        async def read(data):
+            reader = asyncio.StreamReader()
+            reader.feed_data(data)
+            reader.feed_eof()
+            return [await readWebSocketMessageAsync(reader) for _ in range(3)]
+
+        # the third frame is cut off mid mask
+        payload = os.urandom(200)
+        messages = asyncio.run(read(clientFrame(WEBSOCKET_TEXT, b"ack") + clientFrame(WEBSOCKET_BINARY, payload) + b"\x81\x85ab"))
+        self.assertEqual(messages, [(WEBSOCKET_TEXT, b"ack"), (WEBSOCKET_BINARY, payload), (WEBSOCKET_CLOSE, b"")])
+
+class AckTest(unittest.TestCase):
+    def threadedAck(self, data):
+        handler = WebRequestHandler.__new__(WebRequestHandler)
+        handler.rfile = io.BytesIO(data)
+        handler.connection, peer = socket.socketpair()
+        try:
+            acked = handler.waitWebSocketAck()
+            handler.connection.close()
+            written = b""
+            while True:
+                chunk = peer.recv(65536)
+                if not chunk: break
+                written += chunk
+            return acked, serverFrames(written)
+        finally:
+            peer.close()
+
+    def asyncAck(self, data):
+        class Writer:
+            def __init__(self):
+                self.data = b""
+            def write(self, data):
+                self.data += data
+            def writelines(self, buffers):
+                for data in buffers: self.write(data)
+
+        async def run():
+            handler = AsyncRequestHandler.__new__(AsyncRequestHandler)
+            handler.reader = asyncio.StreamReader()
+            handler.reader.feed_data(data)
+            handler.reader.feed_eof()
+            handler.writer = Writer()
+            return await handler.waitWebSocketAck(), serverFrames(handler.writer.data)
+
+        return asyncio.run(run())
+
+    def test_ack(self):
+        for ack in (self.threadedAck, self.asyncAck):
+            self.assertEqual(ack(clientFrame(WEBSOCKET_TEXT, b"ack")), (True, []))
+
+    def test_ping_then_ack(self):
+        data = clientFrame(WEBSOCKET_PING, b"hi") + clientFrame(WEBSOCKET_PING, b"") + clientFrame(WEBSOCKET_TEXT, b"ack")
+        for ack in (self.threadedAck, self.asyncAck):
+            self.assertEqual(ack(data), (True, [(WEBSOCKET_PONG, b"hi"), (WEBSOCKET_PONG, b"")]))
+
+    def test_close(self):
+        data = clientFrame(WEBSOCKET_CLOSE, struct.pack(">H", 1000))
+        for ack in (self.threadedAck, self.asyncAck):
+            self.assertEqual(ack(data), (False, [(WEBSOCKET_CLOSE, b"")]))
+
+    def test_hang_up(self):
+        for ack in (self.threadedAck, self.asyncAck):
+            self.assertEqual(ack(b""), (False, [(WEBSOCKET_CLOSE, b"")]))
+
+    def test_unsolicited_pong_is_ignored(self):
+        data = clientFrame(WEBSOCKET_PONG, b"late") + clientFrame(WEBSOCKET_TEXT, b"ack")
+        for ack in (self.threadedAck, self.asyncAck):
+            self.assertEqual(ack(data), (True, []))
+
+if __name__ == "__main__":
+    unittest.main()
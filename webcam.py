@@ -10,283 +10,1813 @@
 #
 import os
 import sys
-import io
 import time
 import datetime
-# import signal
+import signal
 import threading
 import traceback
 import socket
 import argparse
 import json
+import html
+import functools
+import collections
+import fractions
+import bisect
+import random
+import re
+import queue
+import mmap
+import base64
+import hashlib
+import glob
+import subprocess
 
 import struct
 import ssl
+import asyncio
+import selectors
+import concurrent.futures
+from multiprocessing import shared_memory
 
+from http import HTTPStatus
 from http.server import BaseHTTPRequestHandler, HTTPServer
+from email.utils import formatdate, parsedate_to_datetime
 from socketserver import ThreadingMixIn
-from urllib.parse import urlparse, parse_qs
-from PIL import ImageFont, ImageDraw, Image
+from urllib.parse import urlparse, parse_qs, quote, unquote
+from PIL import ImageFont, ImageDraw, Image, ImageChops, ImageStat
 from io import BytesIO
 
+# optional - speeds up change detection
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 exitCode = os.EX_OK
 myargs = None
 webserver = None
-lastImage = None
-encoderLock = None
-encodeFps = 0.0
-streamFps = {}
-snapshots = 0
+workerPool = None
+workerProcesses = None
+compositor = None
+hostNames = None
+cameras = {}
+
+SNAPSHOT_TAG = "%x" % int(time.time())
+KEEPALIVE_TIMEOUT = 30
+WARMUP_TIMEOUT = 5
+CONNECT_TIMEOUT = 10
+BACKOFF_BASE = 1.
+FRAME_KEEPALIVE = 5
+EVENT_KEEPALIVE = 15
+MOTION_HOLD = 5
 
 class WebRequestHandler(BaseHTTPRequestHandler):
+    # keep-alive for snapshot / info pollers - idle connections are dropped after the timeout
+    protocol_version = "HTTP/1.1"
+    timeout = KEEPALIVE_TIMEOUT
+
     def do_GET(self):
         global exitCode
-        global myargs
-        global streamFps
-        global snapshots
-
-        if self.path.lower().startswith("/?snapshot"):
-            snapshots = snapshots + 1
-            qs = parse_qs(urlparse(self.path).query)
-            if "rotate" in qs:
-                self.sendSnapshot(rotate=int(qs["rotate"][0]))
-                return
-            if myargs.rotate != -1:
-                self.sendSnapshot(rotate=myargs.rotate)
-                return
-            self.sendSnapshot()
+
+        camera, route, params = routeRequest(self.path)
+
+        if route in ("snapshot", "stream", "events"):
+            camera.touch()
+
+        if route == "snapshot":
+            camera.snapshots = camera.snapshots + 1
+            self.sendSnapshot(camera, **params)
             return
 
-        if self.path.lower().startswith("/?stream"):
-            qs = parse_qs(urlparse(self.path).query)
-            if "encodewait" in qs:
-                myargs.encodewait = float(qs["encodewait"][0])
-            showFps = myargs.showfps 
-            if "showfps" in self.path.lower():
-                showFps = True
-            if "hidefps" in self.path.lower():
-                showFps = False
-            if "rotate" in qs:
-                self.streamVideo(rotate=int(qs["rotate"][0]), showFps=showFps)
-                return
-            if myargs.rotate != -1:
-                self.streamVideo(rotate=myargs.rotate, showFps=showFps)
-                return
-            self.streamVideo(showFps=showFps)
+        if route == "stream":
+            self.streamVideo(camera, **params)
             return
 
-        if self.path.lower().startswith("/?info"):
-            self.send_response(200)
-            self.send_header("Content-type", "text/json")
-            self.end_headers()
-            host = self.headers.get('Host')
+        if route == "badrequest":
+            self.sendPage(400, "text/html", "Invalid query string.")
+            return
 
-            fpssum = 0.
-            fpsavg = 0.
+        if route == "info":
+            self.sendPage(200, "text/json", infoPage(self.headers.get('Host'), camera))
+            return
 
-            for fps in streamFps:
-                fpssum = fpssum + streamFps[fps]
+        if route == "metrics":
+            self.sendPage(200, "text/plain; version=0.0.4", metricsPage())
+            return
 
-            if len(streamFps) > 0:
-                fpsavg = fpssum / len(streamFps)
-            else:
-                fpsavg = 0.
+        if route == "frame":
+            self.sendPage(200, "text/html", framePage())
+            return
 
-            jsonstr = ('{"stats":{"server": "%s", "encodeFps": %.2f, "sessionCount": %d, "avgStreamFps": %.2f, "sessions": %s, "snapshots": %d}, "config": %s}' % (host, self.server.getEncodeFps(), len(streamFps), fpsavg, json.dumps(streamFps) if len(streamFps) > 0 else "{}", snapshots, json.dumps(vars(myargs))))
-            self.wfile.write(jsonstr.encode("utf-8"))
+        if route == "events":
+            self.streamEvents(camera)
             return
 
-        if self.path.lower().startswith("/?frame"):
-            self.send_response(200)
-            self.send_header("Content-type", "text/html")
-            self.end_headers()
+        if route == "recordings":
+            self.sendPage(200, "text/json", recordingsPage(camera))
+            return
 
-            self.wfile.write(("<html><head><title>webcamd - A High Performance MJPEG HTTP Server</title></head><body bgcolor='black'><center>" +
-                             "<img width='95%' id='stream' src='/?stream' onclick=\"(function(){stream.src='/?stream&tm='+Date.now();return false;})();return false;\" " +
-                             "onerror=\"(function(){setTimeout(`stream.src='/?stream&tm='+Date.now()`, 10000);return false;})();return false;\" " +
-                             "onabort=\"(function(){setTimeout(`stream.src='/?stream&tm='+Date.now()`, 10000);return false;})();return false;\" " +
-                             "onstalled=\"(function(){setTimeout(`stream.src='/?stream&tm='+Date.now()`, 10000);return false;})();return false;\" " +
-                             "/></center></body></html>").encode("utf-8"))
+        if route == "recording":
+            self.sendRecording(camera, **params)
             return
-        
-        if self.path.lower().startswith("/?shutdown"):
-            self.send_response(200)
-            self.send_header("Content-type", "text/html")
-            self.end_headers()
 
-            self.wfile.write(("<html><head><title>webcamd - A High Performance MJPEG HTTP Server</title></head><body>" +
-                             "webcamd is shutting down now!</body></html>").encode("utf-8"))
+        if route == "shutdown":
+            self.close_connection = True
+            self.sendPage(200, "text/html", shutdownPage())
 
             client = ("%s:%d" % (self.client_address[0], self.client_address[1]))
             print(f"{datetime.datetime.now()}: shutdown requested by {client}", flush=True)
 
             exitCode = os.EX_TEMPFAIL
             self.server.die()
-            self.server.unlockEncoder()
+            self.server.unlockEncoders()
             return
 
-        self.send_response(404)
-        self.send_header("Content-type", "text/html")
-        self.end_headers()
-        host = self.headers.get('Host')
-        self.wfile.write((
-            "<html><head><title>webcamd - A High Performance MJPEG HTTP Server</title></head><body>Specify <a href='http://" + host +
-            "/?frame'>/?frame</a> to host a stream in an <img> object, <a href='http://" + host +
-            "/?stream'>/?stream</a> to stream, <a href='http://" + host +
-            "/?snapshot'>/?snapshot</a> for a picture, or <a href='http://" + host +
-            "/?info'>/?info</a> for statistics and configuration information</body></html>").encode("utf-8"))
+        self.sendPage(404, "text/html", indexPage(self.headers.get('Host')))
 
     def log_message(self, format, *args):
         global myargs
         if not myargs.loghttp: return
         print(f"{datetime.datetime.now()}: {self.client_address[0]} {format % args}", flush=True)
 
+    def sendPage(self, status, contentType, page):
+        page = page.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-type", contentType)
+        self.send_header("Content-length", str(len(page)))
+        if self.close_connection: self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(page)
 
-    def streamVideo(self, rotate=-1, showFps = False):
+    def streamVideo(self, camera, rotate=-1, scale=None, showFps = False, fps=None, quality=None, websocket=False, ack=True):
         global myargs
-        global streamFps
 
         try:
-            if self.server.getImage() is None:
+            if websocket:
+                if not self.acceptWebSocket(): return
+            else:
+                # like snapshots, give a just woken on-demand printer a moment to deliver its first frame
+                if camera.getFrame() is None and myargs.ondemand: camera.waitFrame(0, WARMUP_TIMEOUT)
+                if camera.getFrame() is None:
+                    self.sendPage(200, "text/html", loadingPage())
+                    return
                 self.send_response(200)
-                self.send_header("Content-type", "text/html")
+                self.send_header("Content-type", "multipart/x-mixed-replace; boundary=boundarydonotcross")
+                self.send_header("Connection", "close")
                 self.end_headers()
-                self.wfile.write((
-                    "<html><head><title>webcamd - A High Performance MJPEG HTTP Server</title><meta http-equiv='refresh' content='5'>" +
-                    "</head><body>Loading MJPEG Stream . . .</body></html>").encode("utf-8"))
-                return
-            self.send_response(200)
-            self.send_header("Content-type", "multipart/x-mixed-replace; boundary=boundarydonotcross")
-            self.end_headers()
         except Exception as e:
             print("%s: error in stream header %s: [%s]" % (datetime.datetime.now(), streamKey, e), flush=True)
             return
 
         frames = 0
-        self.server.addSession()
-        streamKey = ("%s:%d" % (socket.getnameinfo((self.client_address[0], 0), 0)[0], self.client_address[1]))
+        camera.addSession()
+        streamKey = sessionName(self.client_address)
+        metrics = StreamMetrics(camera, streamKey)
+        slot = FrameSlot(camera.frameBus)
+        # a write that blocks for longer than maxlag means the client has stopped reading
+        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, STREAM_SEND_BUFFER)
+        self.connection.settimeout(myargs.maxlag if myargs.maxlag > 0 else None)
 
-        fpsFont = ImageFont.truetype("SourceCodePro-Regular.ttf", 14)
-        fmA, fmD = fpsFont.getmetrics()
-        fmD = fmD * -1
-        
         startTime = time.time()
         primed = False
-        addBreaks = False
-
-        showRed = False
+        boundary = b"--boundarydonotcross\r\n"
+        lastData = None
+        lastSent = time.time()
+        lastTimestamp = 0.
 
         while not self is None and not self.server is None and self.server.isRunning():
             if time.time() > startTime + 5:
-                streamFps[streamKey] = frames / 5.
-                # if showfps: print("%s: streaming @ %.2f FPS to %s - wait time %.5f" % (datetime.datetime.now(), streamFps[streamKey], streamKey, myargs.streamwait), flush=True)
+                # sessions start out keyed by ip address until reverse dns catches up
+                name = sessionName(self.client_address)
+                if name != streamKey:
+                    camera.renameSession(streamKey, name)
+                    metrics.rename(name)
+                    streamKey = name
+
+                camera.streamFps[streamKey] = frames / 5.
+                camera.streamDrops[streamKey] = metrics.droppedFrames
+                camera.streamLatency[streamKey] = metrics.latency()
+                # if showfps: print("%s: streaming @ %.2f FPS to %s - wait time %.5f" % (datetime.datetime.now(), camera.streamFps[streamKey], streamKey, myargs.streamwait), flush=True)
                 frames = 0
                 startTime = time.time()
                 primed = True
 
-            jpg = self.server.getImage()
+            # block until the capture loop publishes a newer frame
+            frame = slot.take(1.)
+            # while the printer is reconnecting (or --dedupe holds back frames) repeat the last one so clients don't time out
+            repeat = frame is None and lastData is not None and time.time() > lastSent + FRAME_KEEPALIVE and not websocket
+            if frame is None and not repeat: continue
+            if not repeat:
+                if not frame.inBucket(fps):
+                    metrics.skipped(frame, slot.dropped)
+                    continue
+                metrics.received(frame, slot.dropped)
 
-            if rotate != -1: jpg = jpg.rotate(rotate)
+                # flash on every other frame of the bucket so all of its sessions share the variant
+                showRed = myargs.flashred and frame.flashPhase(fps)
 
-            if showFps and primed: 
-                draw = ImageDraw.Draw(jpg)
+            try:
+                if repeat:
+                    data = lastData
+                elif showFps and primed:
+                    data = self.server.encodeOverlay(camera, frame, rotate, scale, showRed, streamKey, quality)
+                else:
+                    data = frame.getVariant(rotate, scale, "flashred" if showRed else None, quality=quality)
 
-                message = f"{streamKey}\n{datetime.datetime.now()}\nEncode: {round(self.server.getEncodeFps(), 1)} FPS"
+                if not repeat: lastTimestamp = frame.timestamp
+                if websocket:
+                    prefix = websocketHeader(WEBSOCKET_BINARY, len(data))
+                else:
+                    prefix = boundary + b"Content-type: image/jpeg\r\nContent-length: %d\r\nX-Timestamp: %.6f\r\n\r\n" % (len(data), lastTimestamp)
+                writeStart = time.perf_counter()
+                sendBuffers(self.connection, (prefix, data))
+                lastData = data
+                lastSent = time.time()
+                if repeat: continue
+                metrics.sent(len(data), time.perf_counter() - writeStart, lastSent - frame.timestamp)
+
+                boundary = b"\r\n--boundarydonotcross\r\n"
+                frames = frames + 1
 
-                if streamKey in streamFps:
-                    fpssum = 0.
-                    fpsavg = 0.
-                    for fps in streamFps:
-                        fpssum = fpssum + streamFps[fps]
-                    fpsavg = fpssum / len(streamFps)
-                    message = message + f"\nStreams: {len(streamFps)} @ {round(streamFps[streamKey], 1)} FPS"
+                # how long the frame waited on this session, not its age - the first frame may be from before an outage or idle period
+                lag = time.time() - slot.arrivedAt
+                if myargs.maxlag > 0 and lag > myargs.maxlag:
+                    camera.lagged(streamKey, lag)
+                    break
 
-                bbox = draw.textbbox((0, fmD), message, font=fpsFont)
-                draw.rectangle(bbox, fill="black")
-                draw.text((0, fmD), message, font=fpsFont)
-            
-            if myargs.flashred and showRed:
-                draw = ImageDraw.Draw(jpg)
-                bbox = (1910 - 48, 10, 1910, 48 + 10)
-                draw.ellipse(bbox, fill="#82221A", outline="#631710", width=3)
-                bbox = (1910 - 48 + 12, 10 + 12, 1910 - 12, 48 + 10 - 12)
-                draw.ellipse(bbox, fill="#E34234", outline="#AF3025", width=8)
+                # a websocket client acks each frame once it has shown it - meanwhile newer frames just replace each other in the slot
+                if websocket and ack and not self.waitWebSocketAck(): break
+            except socket.timeout:
+                camera.lagged(streamKey, time.time() - (lastSent if repeat else slot.arrivedAt))
+                break
+            except Exception as e:
+                # ignore broken pipes & connection reset
+                if not e.args or e.args[0] not in (32, 104): print(f"{datetime.datetime.now()}: error in stream {streamKey}:: [{e}]", flush=True)
+                break
 
-            showRed = not showRed
+        if streamKey in camera.streamFps: camera.streamFps.pop(streamKey)
+        if streamKey in camera.streamDrops: camera.streamDrops.pop(streamKey)
+        if streamKey in camera.streamLatency: camera.streamLatency.pop(streamKey)
+        slot.close()
+        metrics.close()
+        camera.dropSession()
+
+    def acceptWebSocket(self):
+        key = self.headers.get("sec-websocket-key")
+        if self.headers.get("upgrade", "").lower() != "websocket" or key is None:
+            self.close_connection = True
+            self.sendPage(400, "text/html", "Expected a websocket upgrade.")
+            return False
+
+        self.send_response(101)
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", websocketAccept(key))
+        self.end_headers()
+        self.close_connection = True
+        return True
+
+    # False once the client closed the websocket
+    def waitWebSocketAck(self):
+        while True:
+            opcode, payload = readWebSocketMessage(self.rfile.read)
+            if opcode == WEBSOCKET_PING:
+                sendBuffers(self.connection, (websocketHeader(WEBSOCKET_PONG, len(payload)), payload))
+            elif opcode == WEBSOCKET_CLOSE:
+                self.connection.sendall(websocketHeader(WEBSOCKET_CLOSE, 0))
+                return False
+            elif opcode in (WEBSOCKET_TEXT, WEBSOCKET_BINARY):
+                return True
+
+    # server-sent events - the current motion state, then every change
+    def streamEvents(self, camera):
+        # event subscribers keep an on-demand printer connected and the capture loop running
+        camera.addSession()
+        try:
+            self.send_response(200)
+            self.send_header("Content-type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Connection", "close")
+            self.end_headers()
 
-            try:
-                tmpFile = BytesIO()
-                jpg.save(tmpFile, format="JPEG")
+            lastId = lastEventId(self.headers, camera.events)
+            if lastId == 0:
+                lastId = camera.events.lastId
+                self.wfile.write(eventMessage(lastId, camera.motionEvent()))
+
+            while self.server.isRunning() and not camera.events.closed:
+                events = camera.events.wait(lastId, EVENT_KEEPALIVE)
+                if not events: self.wfile.write(b": keep-alive\n\n")
+                for eventId, event in events:
+                    self.wfile.write(eventMessage(eventId, event))
+                    lastId = eventId
+        except Exception as e:
+            if not e.args or e.args[0] not in (32, 104): print(f"{datetime.datetime.now()}: error in events: [{e}]", flush=True)
+        finally:
+            camera.dropSession()
 
-                if not addBreaks:
-                    self.wfile.write(b"--boundarydonotcross\r\n")
-                    addBreaks = True
-                else:
-                    self.wfile.write(b"\r\n--boundarydonotcross\r\n")
+    def sendSnapshot(self, camera, rotate=-1, scale=None, quality=None):
+        global myargs
+
+        try:
+            frame = camera.getFrame()
+            # an on-demand printer has only just been woken up - give it a moment to deliver its first frame
+            if frame is None and myargs.ondemand: frame = camera.waitFrame(0, WARMUP_TIMEOUT)
+
+            if frame is None:
+                self.send_error(425, "Too Early", "The server is not yet ready to serve requests.  Please try again momentarily.")
+                return
+
+            camera.addSession()
+
+            etag, lastModified = snapshotValidators(frame)
+            if notModified(self.headers, frame, etag):
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Last-Modified", lastModified)
+                self.send_header("Cache-Control", "no-cache")
+                self.end_headers()
+            else:
+                data = self.server.encodeSnapshot(camera, frame, rotate, scale, quality)
 
+                self.send_response(200)
                 self.send_header("Content-type", "image/jpeg")
-                self.send_header("Content-length", str(tmpFile.getbuffer().nbytes))
-                self.send_header("X-Timestamp", "0.000000")
+                self.send_header("Content-length", str(len(data)))
+                self.send_header("ETag", etag)
+                self.send_header("Last-Modified", lastModified)
+                self.send_header("Cache-Control", "no-cache")
                 self.end_headers()
 
-                self.wfile.write(tmpFile.getvalue())
+                self.wfile.write(data)
+        except Exception as e:
+            self.close_connection = True
+            print(f"{datetime.datetime.now()}: error in snapshot: [{e}]", flush=True)
 
-                time.sleep(myargs.streamwait)
-                frames = frames + 1
-            except Exception as e:
-                # ignore broken pipes & connection reset
-                if e.args[0] not in (32, 104): print(f"{datetime.datetime.now()}: error in stream {streamKey}:: [{e}]", flush=True)
-                break
+        camera.dropSession()
 
-        if streamKey in streamFps: streamFps.pop(streamKey)
-        self.server.dropSession()
+    # a recorded frame (?frame= / ?time=) or the whole segment, read through mmap
+    def sendRecording(self, camera, name=None, index=None, at=None):
+        segment = camera.recorder.findSegment(name, at) if camera.recorder is not None else None
+        if segment is None:
+            self.sendPage(404, "text/html", "No such recording.")
+            return
 
-    def sendSnapshot(self, rotate=-1):
         try:
-            jpg = self.server.getImage()
+            with segment:
+                if index is None and at is None:
+                    self.send_response(200)
+                    self.send_header("Content-type", "video/x-motion-jpeg")
+                    self.send_header("Content-length", str(segment.length))
+                    self.send_header("Content-Disposition", 'inline; filename="%s.mjpeg"' % segment.name)
+                    self.end_headers()
+                    for offset in range(0, segment.length, DOWNLOAD_CHUNK):
+                        self.wfile.write(segment.chunk(offset))
+                    return
+
+                index = segment.locate(index, at)
+                if index is None:
+                    self.sendPage(404, "text/html", "No such recording.")
+                    return
+
+                timestamp, data = segment.read(index)
+                self.send_response(200)
+                self.send_header("Content-type", "image/jpeg")
+                self.send_header("Content-length", str(len(data)))
+                self.send_header("X-Timestamp", "%.6f" % timestamp)
+                self.send_header("X-Frame", str(index))
+                self.send_header("Last-Modified", formatdate(timestamp, usegmt=True))
+                self.end_headers()
+                self.wfile.write(data)
+        except Exception as e:
+            self.close_connection = True
+            if not e.args or e.args[0] not in (32, 104): print(f"{datetime.datetime.now()}: error in recording {segment.name}: [{e}]", flush=True)
 
-            if jpg is None:
-                self.send_error(425, "Too Early", "The server is not yet ready to serve requests.  Please try again momentarily.")
+# "/?stream" addresses the first configured printer, "/cam/<name>/?stream" any of them
+def routeRequest(path):
+    global cameras
+
+    url = urlparse(path)
+    if url.path == "/metrics":
+        return None, "metrics", {}
+
+    if url.path == "/":
+        camera = next(iter(cameras.values()))
+    elif url.path.startswith("/cam/"):
+        camera = cameras.get(unquote(url.path[5:].strip("/")))
+    else:
+        camera = None
+
+    if camera is None: return None, None, {}
+
+    # malformed numbers (?fps=abc, ?scale=1/0, ...) are answered with a 400
+    try:
+        return routeQuery(camera, url)
+    except (ValueError, ZeroDivisionError):
+        return camera, "badrequest", {}
+
+def routeQuery(camera, url):
+    global myargs
+
+    lquery = url.query.lower()
+    qs = parse_qs(url.query)
+    rotate = normalizeRotation(int(qs["rotate"][0]) if "rotate" in qs else camera.rotate)
+    scale = parseScale(qs)
+
+    quality = parseQuality(qs)
+
+    if lquery.startswith("snapshot"):
+        return camera, "snapshot", {"rotate": rotate, "scale": scale, "quality": quality}
+
+    if lquery.startswith("stream") or lquery.startswith("ws"):
+        showFps = myargs.showfps 
+        if "showfps" in lquery:
+            showFps = True
+        if "hidefps" in lquery:
+            showFps = False
+        # ?ws is the same stream as one binary websocket message per frame
+        return camera, "stream", {"rotate": rotate, "scale": scale, "showFps": showFps, "fps": parseFps(qs), "quality": quality,
+                                  "websocket": lquery.startswith("ws"), "ack": "noack" not in lquery}
+
+    if lquery.startswith("recordings"):
+        return camera, "recordings", {}
+
+    if lquery.startswith("recording"):
+        return camera, "recording", {"name": qs["recording"][0] if "recording" in qs else None,
+                                     "index": int(qs["frame"][0]) if "frame" in qs else None,
+                                     "at": float(qs["time"][0]) if "time" in qs else None}
+
+    for route in ("info", "frame", "events", "shutdown"):
+        if lquery.startswith(route): return camera, route, {}
+
+    return camera, None, {}
+
+# Per session ?fps= and ?quality= are rounded to a few shared buckets so sessions asking for similar
+# settings share their encodes.  ?encodewait= is still honoured as 1 / fps for this session only.
+FPS_BUCKETS = (.5, 1., 2., 5., 10., 15., 30.)
+QUALITY_BUCKETS = (25, 50, 75, 90)
+
+def parseFps(qs):
+    if "fps" in qs:
+        fps = float(qs["fps"][0])
+    elif "encodewait" in qs and float(qs["encodewait"][0]) > 0:
+        fps = 1. / float(qs["encodewait"][0])
+    else:
+        return None
+
+    # round down so a session never gets more frames than it asked for
+    return max([bucket for bucket in FPS_BUCKETS if bucket <= fps], default=FPS_BUCKETS[0])
+
+def parseQuality(qs):
+    if "quality" not in qs: return None
+    quality = int(qs["quality"][0])
+    return min(QUALITY_BUCKETS, key=lambda bucket: abs(bucket - quality))
+
+# ?width= / ?height= / ?scale= replace the --width / --height bounding box; frames are only ever scaled down
+def parseScale(qs):
+    global myargs
+
+    if "width" in qs or "height" in qs or "scale" in qs:
+        return Scale(int(qs["width"][0]) if "width" in qs else 0,
+                     int(qs["height"][0]) if "height" in qs else 0,
+                     float(fractions.Fraction(qs["scale"][0])) if "scale" in qs else 0.,
+                     True)
+
+    return Scale(myargs.width, myargs.height, 0., False)
+
+def infoPage(host, camera):
+    global myargs
+    global cameras
+
+    streamFps, streamDrops, streamLatency, lagDisconnects, snapshots = sessionStats(camera)
+
+    fpssum = 0.
+    fpsavg = 0.
+
+    for fps in streamFps:
+        fpssum = fpssum + streamFps[fps]
+
+    if len(streamFps) > 0:
+        fpsavg = fpssum / len(streamFps)
+    else:
+        fpsavg = 0.
+
+    return ('{"stats":{"server": "%s", "camera": %s, "cameras": %s, "encodeFps": %.2f, "sessionCount": %d, "avgStreamFps": %.2f, "sessions": %s, "droppedFrames": %s, "latency": %s, "lagDisconnects": %d, "snapshots": %d, "connected": %s, "motion": %s}, "config": %s}' % (host, json.dumps(camera.name), json.dumps(list(cameras)), camera.getEncodeFps(), len(streamFps), fpsavg, json.dumps(streamFps) if len(streamFps) > 0 else "{}", json.dumps(streamDrops), json.dumps(streamLatency), lagDisconnects, snapshots, json.dumps(camera.connected), json.dumps(camera.motion), json.dumps(vars(myargs))))
+
+# Shows ?ws frames, acking each one once it has been drawn so a congested link only ever carries the newest frame.
+# Browsers without websockets, or servers that refuse the upgrade, get the multipart stream instead.
+def framePage():
+    return ("<html><head><title>webcamd - A High Performance MJPEG HTTP Server</title></head><body bgcolor='black'><center>" +
+            "<img width='95%' id='stream'/></center><script>" +
+            "function multipart(){" +
+            "stream.onclick=function(){stream.src='?stream&tm='+Date.now();};" +
+            "stream.onerror=stream.onabort=stream.onstalled=function(){setTimeout(function(){stream.src='?stream&tm='+Date.now();}, 10000);};" +
+            "stream.onload=null;stream.src='?stream';}" +
+            "function websocket(){" +
+            "if(!window.WebSocket) return multipart();" +
+            "var socket=new WebSocket((location.protocol=='https:'?'wss://':'ws://')+location.host+location.pathname+'?ws'), received=false;" +
+            "socket.onmessage=function(event){received=true;var url=URL.createObjectURL(event.data);" +
+            "stream.onload=stream.onerror=function(){URL.revokeObjectURL(url);if(socket.readyState==1) socket.send('ack');};stream.src=url;};" +
+            "socket.onclose=function(){if(received) setTimeout(websocket, 2000); else multipart();};}" +
+            "websocket();</script></body></html>")
+
+def shutdownPage():
+    return ("<html><head><title>webcamd - A High Performance MJPEG HTTP Server</title></head><body>" +
+            "webcamd is shutting down now!</body></html>")
+
+def loadingPage():
+    return ("<html><head><title>webcamd - A High Performance MJPEG HTTP Server</title><meta http-equiv='refresh' content='5'>" +
+            "</head><body>Loading MJPEG Stream . . .</body></html>")
+
+def indexPage(host):
+    global cameras
+
+    links = ", ".join("<a href='http://%s/cam/%s/?frame'>%s</a>" % (host, quote(name), html.escape(name)) for name in cameras)
+
+    return ("<html><head><title>webcamd - A High Performance MJPEG HTTP Server</title></head><body>Specify <a href='http://" + host +
+            "/?frame'>/?frame</a> to host a stream in an <img> object, <a href='http://" + host +
+            "/?stream'>/?stream</a> to stream, <a href='http://" + host +
+            "/?snapshot'>/?snapshot</a> for a picture, or <a href='http://" + host +
+            "/?info'>/?info</a> for statistics and configuration information.  Prefix any of these with /cam/&lt;name&gt;/ " +
+            "to address a specific printer: " + links + "</body></html>")
+
+# Snapshot validators.  Frame versions restart with the process, so etags also carry the start time.  With
+# --workers, versions are the capture process's ring sequence numbers and the tag is the capture process's.
+def snapshotValidators(frame):
+    return '"%s-%d"' % (SNAPSHOT_TAG, frame.version), formatdate(frame.timestamp, usegmt=True)
+
+def notModified(headers, frame, etag):
+    match = headers.get("if-none-match")
+    if match is not None:
+        tags = [tag.strip().removeprefix("W/") for tag in match.split(",")]
+        return "*" in tags or etag in tags
+
+    since = headers.get("if-modified-since")
+    if since is not None:
+        try:
+            # Last-Modified only has whole seconds
+            return int(frame.timestamp) <= parsedate_to_datetime(since).timestamp()
+        except (TypeError, ValueError):
+            return False
+
+    return False
+
+def getHostName(address):
+    return socket.getnameinfo((address, 0), 0)[0]
+
+# Reverse DNS for session names and watermarks.  Lookups never block a request - an unknown address is
+# returned as-is while a background thread resolves it, and cached names are refreshed once older than the ttl.
+class HostNameCache:
+    MAX_ENTRIES = 1024
+
+    def __init__(self, ttl, enabled=True):
+        self.ttl = ttl
+        self.enabled = enabled
+        self.names = {}
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.resolver = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix="webcamd-dns") if enabled else None
+
+    def lookup(self, address):
+        if not self.enabled: return address
+
+        entry = self.names.get(address)
+        if entry is None or time.monotonic() > entry[1]:
+            with self.lock:
+                if address not in self.pending:
+                    self.pending.add(address)
+                    self.resolver.submit(self.resolve, address)
+
+        return address if entry is None else entry[0]
+
+    def resolve(self, address):
+        try:
+            name = getHostName(address)
+        except Exception:
+            name = address
+
+        with self.lock:
+            if len(self.names) >= self.MAX_ENTRIES:
+                now = time.monotonic()
+                self.names = {key: entry for key, entry in self.names.items() if entry[1] > now}
+            self.names[address] = (name, time.monotonic() + self.ttl)
+            self.pending.discard(address)
+
+def snapshotText(camera, frame):
+    return f"{camera.name}\n{datetime.datetime.fromtimestamp(frame.timestamp).replace(microsecond=0)}"
+
+def sessionName(address):
+    global hostNames
+    return "%s:%d" % (hostNames.lookup(address[0]), address[1])
+
+# Minimal Prometheus instrumentation.  Updates are plain attribute arithmetic without locks - under
+# the GIL an occasional lost increment is an acceptable price for keeping the hot loops cheap.
+METRICS = []
+TIME_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10.)
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def merge(self, counts, total):
+        self.counts = [count + other for count, other in zip(self.counts, counts)]
+        self.sum += total
+
+class MetricFamily:
+    def __init__(self, kind, name, help, labelNames=(), buckets=TIME_BUCKETS):
+        self.kind = kind
+        self.name = name
+        self.help = help
+        self.labelNames = labelNames
+        self.buckets = buckets
+        self.children = {}
+        METRICS.append(self)
+
+    # resolve once and keep the child around in hot loops
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            child = self.children.setdefault(values, self.newChild())
+        return child
+
+    def remove(self, *values):
+        self.children.pop(values, None)
+
+    def newChild(self):
+        return Histogram(self.buckets) if self.kind == "histogram" else Counter()
+
+    # plain json for the --workers stats files
+    def state(self):
+        if self.kind == "histogram": return [[list(values), list(child.counts), child.sum] for values, child in list(self.children.items())]
+        return [[list(values), child.value] for values, child in list(self.children.items())]
+
+    # children defaults to this process's own - with --workers, the sum over every process
+    def expose(self, lines, children=None):
+        if children is None: children = self.children
+        lines.append(f"# HELP {self.name} {self.help}")
+        lines.append(f"# TYPE {self.name} {self.kind}")
+        for values, child in list(children.items()):
+            labels = ",".join('%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"')) for name, value in zip(self.labelNames, values))
+            braced = "{%s}" % labels if labels else ""
+            if self.kind != "histogram":
+                lines.append("%s%s %s" % (self.name, braced, child.value))
+                continue
+            separator = "," if labels else ""
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), list(child.counts)):
+                cumulative += count
+                lines.append('%s_bucket{%s%sle="%s"} %d' % (self.name, labels, separator, "+Inf" if bound == float("inf") else bound, cumulative))
+            lines.append("%s_sum%s %f" % (self.name, braced, child.sum))
+            lines.append("%s_count%s %d" % (self.name, braced, cumulative))
+
+TLS_READ_SECONDS = MetricFamily("histogram", "webcamd_tls_read_seconds", "Time spent in TLS reads per captured frame", ("camera",))
+ASSEMBLY_SECONDS = MetricFamily("histogram", "webcamd_frame_assembly_seconds", "Time from a frame header arriving to its last payload byte", ("camera",))
+DECODE_SECONDS = MetricFamily("histogram", "webcamd_decode_seconds", "Time spent decoding captured jpegs")
+TRANSFORM_SECONDS = MetricFamily("histogram", "webcamd_transform_seconds", "Time spent rotating, resizing and drawing overlays")
+ENCODE_SECONDS = MetricFamily("histogram", "webcamd_encode_seconds", "Time spent encoding jpegs")
+RENDER_SECONDS = MetricFamily("histogram", "webcamd_render_seconds", "Total time to render a frame variant, locally or in a worker process")
+STAGE_SECONDS = {family.name: family for family in (DECODE_SECONDS, TRANSFORM_SECONDS, ENCODE_SECONDS)}
+FRAME_AGE_SECONDS = MetricFamily("histogram", "webcamd_frame_age_seconds", "Time from a frame's last byte arriving from the printer to it being written to a client", ("camera",))
+WRITE_SECONDS = MetricFamily("histogram", "webcamd_socket_write_seconds", "Time spent writing one frame to a client socket", ("camera",))
+BYTES_SENT = MetricFamily("counter", "webcamd_bytes_sent_total", "Bytes of frame data sent to clients", ("camera",))
+SESSION_BYTES = MetricFamily("counter", "webcamd_session_bytes_sent_total", "Bytes of frame data sent to each active stream session", ("camera", "session"))
+FRAMES_PUBLISHED = MetricFamily("counter", "webcamd_frames_published_total", "Frames published by the capture loop", ("camera",))
+FRAMES_DISCARDED = MetricFamily("counter", "webcamd_frames_discarded_total", "Frames read from the printer but not published", ("camera", "reason"))
+FRAMES_DROPPED = MetricFamily("counter", "webcamd_frames_dropped_total", "Published frames a stream session skipped because a newer frame was already available", ("camera",))
+FRAMES_STALE = MetricFamily("counter", "webcamd_frames_stale_total", "Frames that were already superseded by the time they were written to a client", ("camera",))
+LAG_DISCONNECTS = MetricFamily("counter", "webcamd_lag_disconnects_total", "Stream sessions disconnected for falling more than --maxlag seconds behind", ("camera",))
+FRAMES_RECORDED = MetricFamily("counter", "webcamd_frames_recorded_total", "Frames appended to recording segments", ("camera",))
+RECORDER_DROPS = MetricFamily("counter", "webcamd_recorder_dropped_total", "Frames not recorded because the disk fell behind", ("camera",))
+FRAMES_EXPORTED = MetricFamily("counter", "webcamd_frames_exported_total", "Frames written to the shared memory ring", ("camera",))
+RECONNECTS = MetricFamily("counter", "webcamd_reconnects_total", "Printer connections re-established by the capture loop", ("camera",))
+MOTION = MetricFamily("gauge", "webcamd_motion", "1 while motion is detected on the printer camera", ("camera",))
+SESSIONS = MetricFamily("gauge", "webcamd_sessions", "Active stream, snapshot and event sessions", ("camera",))
+
+# per stream session bookkeeping shared by both front-ends
+class StreamMetrics:
+    def __init__(self, camera, session):
+        self.camera = camera
+        self.session = session
+        self.version = 0
+        self.droppedFrames = 0
+        self.sessionBytes = SESSION_BYTES.labels(camera.name, session)
+        self.bytesSent = BYTES_SENT.labels(camera.name)
+        self.writeSeconds = WRITE_SECONDS.labels(camera.name)
+        self.dropped = FRAMES_DROPPED.labels(camera.name)
+        self.stale = FRAMES_STALE.labels(camera.name)
+        self.frameAge = FRAME_AGE_SECONDS.labels(camera.name)
+        self.ages = collections.deque(maxlen=LATENCY_SAMPLES)
+
+    # overwritten is how many unsent frames the session's slot replaced before this one - frame versions can't
+    # tell, since with --workers they are ring sequence numbers with gaps for frames the worker never published
+    def received(self, frame, overwritten=0):
+        if overwritten:
+            self.droppedFrames += overwritten
+            self.dropped.inc(overwritten)
+        self.version = frame.version
+
+    # frames left out on purpose because the session runs at a lower fps
+    def skipped(self, frame, overwritten=0):
+        self.received(frame, overwritten)
+
+    # age is capture to socket - how old the frame was once the kernel had it
+    def sent(self, length, seconds, age):
+        self.sessionBytes.inc(length)
+        self.bytesSent.inc(length)
+        self.writeSeconds.observe(seconds)
+        self.frameAge.observe(age)
+        self.ages.append(age)
+        if self.camera.getFrame().version != self.version: self.stale.inc()
+
+    def rename(self, session):
+        sent = self.sessionBytes.value
+        SESSION_BYTES.remove(self.camera.name, self.session)
+        self.session = session
+        self.sessionBytes = SESSION_BYTES.labels(self.camera.name, session)
+        self.sessionBytes.inc(sent)
+
+    def latency(self):
+        return latencyPercentiles(self.ages)
+
+    def close(self):
+        SESSION_BYTES.remove(self.camera.name, self.session)
+
+# per session frame age percentiles over the last LATENCY_SAMPLES frames, in milliseconds
+LATENCY_SAMPLES = 256
+
+def latencyPercentiles(ages):
+    if not ages: return {}
+    ordered = sorted(ages)
+    pick = lambda fraction: round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000., 1)
+    return {"p50": pick(.5), "p95": pick(.95), "p99": pick(.99), "max": round(ordered[-1] * 1000., 1)}
+
+def updateGauges():
+    global cameras
+
+    for camera in cameras.values():
+        SESSIONS.labels(camera.name).value = camera.getSessions()
+
+def metricsPage():
+    global myargs
+
+    updateGauges()
+    lines = []
+    if myargs.worker is None:
+        for metric in METRICS: metric.expose(lines)
+    else:
+        for metric, children in clusterMetrics().items(): metric.expose(lines, children)
+    return "\n".join(lines) + "\n"
+
+def metricState():
+    updateGauges()
+    return {metric.name: metric.state() for metric in METRICS}
+
+# --workers: capture side metrics live in the capture process and every worker counts its own sessions, so a
+# scrape answered by any worker adds up the metrics all processes write to their stats files.  Our own numbers
+# come from our file too - mixing in fresher local values would make counters jump back on the next scrape
+# answered by another worker.
+def clusterMetrics():
+    states = [readStats(path).get("metrics", {}) for path in glob.glob(clusterPrefix() + ".*.json")]
+    merged = {}
+    for metric in METRICS:
+        children = merged.setdefault(metric, {})
+        for state in states:
+            for entry in state.get(metric.name, []):
+                child = children.get(tuple(entry[0]))
+                if child is None: child = children.setdefault(tuple(entry[0]), metric.newChild())
+                if metric.kind == "histogram":
+                    child.merge(entry[1], entry[2])
+                else:
+                    child.inc(entry[1])
+    return merged
+
+class FrameError(Exception):
+    pass
+
+# Reassembles the printer's length prefixed jpeg stream from a non-blocking TLS socket.  Each payload
+# is read with recv_into straight into a buffer preallocated from its header, and returned the moment
+# its last byte lands, regardless of how the header and payload were split across TLS records.
+class FrameReader:
+    HEADER_SIZE = 16
+    MAX_PAYLOAD_SIZE = 16 * 1024 * 1024
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(sock, selectors.EVENT_READ)
+        self.header = bytearray(self.HEADER_SIZE)
+        self.readSeconds = 0.
+        self.startedAt = 0.
+        self.frameReadSeconds = 0.
+        self.frameAssemblySeconds = 0.
+        self.completedAt = 0.
+        self.expect(self.header)
+
+    def expect(self, buffer):
+        self.buffer = buffer
+        self.view = memoryview(buffer)
+        self.offset = 0
+
+    # returns a complete payload, None if nothing arrived within timeout, raises EOFError when the printer hangs up
+    def readFrame(self, timeout):
+        deadline = time.monotonic() + timeout
+
+        while True:
+            readStart = time.perf_counter()
+            try:
+                count = self.sock.recv_into(self.view[self.offset:])
+            except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+                self.readSeconds += time.perf_counter() - readStart
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self.selector.select(remaining): return None
+                continue
+            self.readSeconds += time.perf_counter() - readStart
+
+            if count == 0: raise EOFError()
+            if self.offset == 0 and self.buffer is self.header: self.startedAt = readStart
+
+            self.offset += count
+            if self.offset < len(self.buffer): continue
+
+            if self.buffer is self.header:
+                payload_size = struct.unpack_from("<I", self.header)[0]
+                if payload_size == 0 or payload_size > self.MAX_PAYLOAD_SIZE:
+                    raise FrameError(f"invalid payload size {payload_size} in frame header")
+                self.expect(bytearray(payload_size))
+            else:
+                payload = self.buffer
+                # wall clock capture time - sent as X-Timestamp and used for end to end latency
+                self.completedAt = time.time()
+                self.expect(self.header)
+                self.frameReadSeconds = self.readSeconds
+                self.frameAssemblySeconds = time.perf_counter() - self.startedAt
+                self.readSeconds = 0.
+                return payload
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.selector.close()
+
+def encodeImage(jpg, quality=None):
+    tmpFile = BytesIO()
+    if quality is None:
+        jpg.save(tmpFile, format="JPEG")
+    else:
+        jpg.save(tmpFile, format="JPEG", quality=quality)
+    return tmpFile.getvalue()
+
+# oriented boxes apply to the rotated frame, otherwise to the frame as captured
+Scale = collections.namedtuple("Scale", ["width", "height", "factor", "oriented"])
+
+RIGHT_ANGLES = {90: Image.Transpose.ROTATE_90, 180: Image.Transpose.ROTATE_180, 270: Image.Transpose.ROTATE_270}
+
+# -1 means no rotation, anything else is folded into 1-359 so equivalent angles share one cached frame
+def normalizeRotation(rotate):
+    if rotate == -1 or rotate % 360 == 0: return -1
+    return rotate % 360
+
+def rotateImage(image, rotate):
+    # right angles are a lossless pixel shuffle (and keep the whole picture), anything else is resampled
+    transpose = RIGHT_ANGLES.get(rotate)
+    if transpose is not None: return image.transpose(transpose)
+    return image.rotate(rotate)
+
+# Caches everything drawn on top of frames.  The font is loaded once, text blocks are rasterised only
+# when their content changes and the flashred dot is pre-rendered, so compositing is a single paste.
+class OverlayCompositor:
+    MAX_SPRITES = 256
+
+    def __init__(self, fontFile="SourceCodePro-Regular.ttf", fontSize=14):
+        self.font = ImageFont.truetype(fontFile, fontSize)
+        fmA, fmD = self.font.getmetrics()
+        self.origin = (0, fmD * -1)
+        self.measure = ImageDraw.Draw(Image.new("RGB", (1, 1)))
+        self.sprites = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+        self.redDot = Image.new("RGBA", (49, 49), (0, 0, 0, 0))
+        draw = ImageDraw.Draw(self.redDot)
+        draw.ellipse((0, 0, 48, 48), fill="#82221A", outline="#631710", width=3)
+        draw.ellipse((12, 12, 36, 36), fill="#E34234", outline="#AF3025", width=8)
+
+    # freetype faces are not thread safe, so rasterising happens under the lock
+    def getTextSprite(self, message):
+        with self.lock:
+            sprite = self.sprites.get(message)
+            if sprite is None:
+                bbox = self.measure.textbbox(self.origin, message, font=self.font)
+                sprite = Image.new("RGB", (max(bbox[2], 1), max(bbox[3], 1)), "black")
+                ImageDraw.Draw(sprite).text(self.origin, message, font=self.font)
+                self.sprites[message] = sprite
+                if len(self.sprites) > self.MAX_SPRITES: self.sprites.popitem(last=False)
+            else:
+                self.sprites.move_to_end(message)
+            return sprite
+
+    def drawText(self, jpg, message):
+        jpg.paste(self.getTextSprite(message), (0, 0))
+
+    def drawFlashRed(self, jpg):
+        jpg.paste(self.redDot, (jpg.width - 10 - 48, 10), self.redDot)
+
+# An immutable captured frame.  The printer's jpeg bytes never change once published, so
+# decoded images and encoded variants are rendered on first request and shared by every session.
+class Frame:
+    def __init__(self, data, version, previousTimestamp=0., timestamp=None):
+        self.data = data
+        self.version = version
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self.previousTimestamp = previousTimestamp
+        self.lock = threading.RLock()
+        self.size = None
+        self.images = {}
+        self.variants = {}
+        self.variantLocks = {}
+        self.shared = None
+        self.sharedUsers = 0
+        self.retired = False
+
+    def getSize(self):
+        if self.size is None:
+            # only parses the jpeg header
+            self.size = Image.open(BytesIO(self.data)).size
+        return self.size
+
+    # the pre-rotation size to decode at so the rotated result fits scale, or None for full size
+    def fitSize(self, rotate, scale):
+        if scale is None: return None
+
+        width, height = self.getSize()
+        fitWidth, fitHeight = (height, width) if scale.oriented and rotate in (90, 270) else (width, height)
+
+        ratio = 1.
+        if scale.factor > 0: ratio = min(ratio, scale.factor)
+        if scale.width > 0: ratio = min(ratio, scale.width / fitWidth)
+        if scale.height > 0: ratio = min(ratio, scale.height / fitHeight)
+        if ratio >= 1.: return None
+
+        return (max(1, round(width * ratio)), max(1, round(height * ratio)))
+
+    def isPassthrough(self, rotate, scale, quality=None):
+        global myargs
+        return myargs.passthrough and rotate == -1 and quality is None and self.fitSize(rotate, scale) is None
+
+    # whether a session limited to fps should show this frame - the first frame of every 1/fps slot,
+    # so all sessions in the same fps bucket pick the same frames and share their encodes
+    def inBucket(self, fps):
+        return fps is None or int(self.timestamp * fps) != int(self.previousTimestamp * fps)
+
+    def flashPhase(self, fps):
+        return (self.version if fps is None else int(self.timestamp * fps)) % 2 == 0
+
+    # callers must copy() the returned image before drawing on it
+    def getImage(self, rotate=-1, size=None):
+        key = (rotate, size)
+        image = self.images.get(key)
+        if image is None:
+            with self.lock:
+                image = self.images.get(key)
+                if image is None:
+                    if rotate == -1:
+                        decodeStart = time.perf_counter()
+                        image = Image.open(BytesIO(self.data))
+                        if size is not None:
+                            # let libjpeg decode straight to 1/2, 1/4 or 1/8 scale, then resize the remainder
+                            image.draft("RGB", size)
+                        image = image.convert('RGB')
+                        observeStage(DECODE_SECONDS, time.perf_counter() - decodeStart)
+                        if size is not None and image.size != size:
+                            transformStart = time.perf_counter()
+                            image = image.resize(size, Image.Resampling.BILINEAR)
+                            observeStage(TRANSFORM_SECONDS, time.perf_counter() - transformStart)
+                    else:
+                        image = self.getImage(-1, size)
+                        transformStart = time.perf_counter()
+                        image = rotateImage(image, rotate)
+                        observeStage(TRANSFORM_SECONDS, time.perf_counter() - transformStart)
+                    self.images[key] = image
+        return image
+
+    def cachedVariant(self, rotate=-1, scale=None, overlay=None, quality=None):
+        return self.variants.get((rotate, self.fitSize(rotate, scale), overlay, quality))
+
+    def getVariant(self, rotate=-1, scale=None, overlay=None, text=None, quality=None):
+        global myargs
+        global compositor
+
+        size = self.fitSize(rotate, scale)
+        key = (rotate, size, overlay, quality)
+        variant = self.variants.get(key)
+        if variant is not None: return variant
+
+        with self.variantLocks.setdefault(key, threading.Lock()):
+            variant = self.variants.get(key)
+            if variant is None:
+                if rotate == -1 and size is None and overlay is None and quality is None and myargs.passthrough:
+                    variant = self.data
+                else:
+                    variant = self.render(rotate, size, text, overlay == "flashred", quality)
+                self.variants[key] = variant
+        return variant
+
+    # decode, rotate, draw and encode - in a worker process when --processes is set
+    def render(self, rotate=-1, size=None, text=None, flashRed=False, quality=None):
+        global workerProcesses
+        global compositor
+
+        renderStart = time.perf_counter()
+
+        if workerProcesses is not None:
+            name = self.acquireShared()
+            try:
+                jpg, timings = workerProcesses.submit(renderShared, name, len(self.data), rotate, size, text, flashRed, quality).result()
+            finally:
+                self.releaseShared()
+            for metric, seconds in timings:
+                STAGE_SECONDS[metric].labels().observe(seconds)
+            RENDER_SECONDS.labels().observe(time.perf_counter() - renderStart)
+            return jpg
+
+        jpg = self.getImage(rotate, size)
+        if text is not None or flashRed:
+            transformStart = time.perf_counter()
+            jpg = jpg.copy()
+            if text is not None: compositor.drawText(jpg, text)
+            if flashRed: compositor.drawFlashRed(jpg)
+            observeStage(TRANSFORM_SECONDS, time.perf_counter() - transformStart)
+
+        encodeStart = time.perf_counter()
+        jpg = encodeImage(jpg, quality)
+        observeStage(ENCODE_SECONDS, time.perf_counter() - encodeStart)
+        RENDER_SECONDS.labels().observe(time.perf_counter() - renderStart)
+        return jpg
+
+    # the jpeg bytes are copied into shared memory once per frame, no matter how many workers read them
+    def acquireShared(self):
+        with self.lock:
+            if self.shared is None:
+                self.shared = shared_memory.SharedMemory(create=True, size=len(self.data))
+                self.shared.buf[:len(self.data)] = self.data
+            self.sharedUsers = self.sharedUsers + 1
+            return self.shared.name
+
+    def releaseShared(self):
+        with self.lock:
+            self.sharedUsers = self.sharedUsers - 1
+            self.freeShared()
+
+    # called once a newer frame has been published
+    def retire(self):
+        with self.lock:
+            self.retired = True
+            self.freeShared()
+
+    def freeShared(self):
+        if self.retired and self.sharedUsers == 0 and self.shared is not None:
+            self.shared.close()
+            self.shared.unlink()
+            self.shared = None
+
+# worker processes collect their stage timings here so the parent can observe them - their own metrics are never scraped
+stageTimings = None
+
+def observeStage(family, seconds):
+    if stageTimings is None:
+        family.labels().observe(seconds)
+    else:
+        stageTimings.append((family.name, seconds))
+
+def initWorker():
+    global workerProcesses
+    global compositor
+
+    # forked workers inherit the parent's pool - make sure they render locally
+    workerProcesses = None
+    compositor = OverlayCompositor()
+    # and its SIGTERM handler, which would wait forever for a web server that doesn't run here
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+def renderShared(name, length, rotate, size, text, flashRed, quality):
+    global stageTimings
+
+    shared = shared_memory.SharedMemory(name=name)
+    try:
+        data = bytes(shared.buf[:length])
+    finally:
+        shared.close()
+    stageTimings = []
+    try:
+        jpg = Frame(data, 0).render(rotate, size, text, flashRed, quality)
+        return jpg, stageTimings
+    finally:
+        stageTimings = None
+
+class FrameBus:
+    def __init__(self):
+        self.frame = None
+        self.closed = False
+        self.condition = threading.Condition()
+        self.subscribers = []
+
+    def publish(self, data, timestamp=None, version=None):
+        with self.condition:
+            previous = self.frame
+            if version is None: version = 1 if previous is None else previous.version + 1
+            self.frame = Frame(data, version, 0., timestamp) if previous is None else Frame(data, version, previous.timestamp, timestamp)
+            self.condition.notify_all()
+        if previous is not None: previous.retire()
+        for subscriber in self.subscribers:
+            subscriber(self.frame)
+
+    def subscribe(self, callback):
+        self.subscribers = self.subscribers + [callback]
+
+    def unsubscribe(self, callback):
+        self.subscribers = [subscriber for subscriber in self.subscribers if subscriber != callback]
+
+    def getFrame(self):
+        return self.frame
+
+    def waitFrame(self, version, timeout=None):
+        with self.condition:
+            self.condition.wait_for(lambda: self.closed or (self.frame is not None and self.frame.version != version), timeout)
+            return self.frame
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        if self.frame is not None: self.frame.retire()
+
+# per stream socket send buffer - small enough that a slow client skips frames instead of the kernel queueing them
+STREAM_SEND_BUFFER = 128 * 1024
+
+# A stream session's mailbox - only ever holds the newest frame, so a slow client skips frames instead of queueing them
+class FrameSlot:
+    def __init__(self, frameBus, loop=None):
+        self.frameBus = frameBus
+        self.frame = frameBus.getFrame()
+        # when the pending frame reached this slot, and when the last taken one did
+        self.putAt = time.time()
+        self.arrivedAt = self.putAt
+        # unsent frames replaced by newer ones - pending, and before the last taken frame
+        self.overwritten = 0
+        self.dropped = 0
+        self.condition = threading.Condition()
+        self.loop = loop
+        self.event = asyncio.Event() if loop is not None else None
+        frameBus.subscribe(self.put)
+
+    # called on the capture thread
+    def put(self, frame):
+        with self.condition:
+            if self.frame is not None: self.overwritten = self.overwritten + 1
+            self.frame = frame
+            self.putAt = time.time()
+            self.condition.notify()
+        if self.loop is not None: self.loop.call_soon_threadsafe(self.event.set)
+
+    def take(self, timeout=None):
+        with self.condition:
+            if self.frame is None and timeout != 0: self.condition.wait(timeout)
+            frame, self.frame = self.frame, None
+            if frame is not None:
+                self.arrivedAt = self.putAt
+                self.dropped, self.overwritten = self.overwritten, 0
+            return frame
+
+    async def takeAsync(self, timeout=None):
+        self.event.clear()
+        frame = self.take(0)
+        if frame is None:
+            try:
+                await asyncio.wait_for(self.event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            frame = self.take(0)
+        return frame
+
+    def close(self):
+        self.frameBus.unsubscribe(self.put)
+
+# Send a multipart part as one vectored write, resuming after partial sends
+def sendBuffers(sock, buffers):
+    views = [memoryview(buffer) for buffer in buffers]
+    while views:
+        sent = sock.sendmsg(views)
+        while views and sent >= len(views[0]):
+            sent -= len(views[0])
+            views.pop(0)
+        if sent: views[0] = views[0][sent:]
+
+# Just enough of RFC 6455 for ?ws - unfragmented binary frames out, small masked acks / pings / closes in
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+WEBSOCKET_TEXT = 0x1
+WEBSOCKET_BINARY = 0x2
+WEBSOCKET_CLOSE = 0x8
+WEBSOCKET_PING = 0x9
+WEBSOCKET_PONG = 0xa
+MAX_WEBSOCKET_MESSAGE = 4096
+
+def websocketAccept(key):
+    return base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode("ascii")).digest()).decode("ascii")
+
+def websocketHeader(opcode, length):
+    if length < 126: return struct.pack(">BB", 0x80 | opcode, length)
+    if length < 65536: return struct.pack(">BBH", 0x80 | opcode, 126, length)
+    return struct.pack(">BBQ", 0x80 | opcode, 127, length)
+
+def websocketUnmask(mask, payload):
+    if not mask or not payload: return payload
+    key = (mask * (len(payload) // 4 + 1))[:len(payload)]
+    return (int.from_bytes(payload, "big") ^ int.from_bytes(key, "big")).to_bytes(len(payload), "big")
+
+# read(n) returns n bytes or fewer at end of stream - (opcode, payload), a close when the client went away
+def readWebSocketMessage(read):
+    header = read(2)
+    if len(header) < 2: return WEBSOCKET_CLOSE, b""
+    length = header[1] & 0x7f
+    if length == 126: length = struct.unpack(">H", read(2))[0]
+    elif length == 127: length = struct.unpack(">Q", read(8))[0]
+    if length > MAX_WEBSOCKET_MESSAGE: return WEBSOCKET_CLOSE, b""
+    mask = read(4) if header[1] & 0x80 else b""
+    return header[0] & 0x0f, websocketUnmask(mask, read(length))
+
+async def readWebSocketMessageAsync(reader):
+    try:
+        header = await reader.readexactly(2)
+        length = header[1] & 0x7f
+        if length == 126: length = struct.unpack(">H", await reader.readexactly(2))[0]
+        elif length == 127: length = struct.unpack(">Q", await reader.readexactly(8))[0]
+        if length > MAX_WEBSOCKET_MESSAGE: return WEBSOCKET_CLOSE, b""
+        mask = await reader.readexactly(4) if header[1] & 0x80 else b""
+        return header[0] & 0x0f, websocketUnmask(mask, await reader.readexactly(length))
+    except asyncio.IncompleteReadError:
+        return WEBSOCKET_CLOSE, b""
+
+# Motion / change detection on a tiny luma thumbnail - the jpeg is only decoded at 1/8 scale
+class ChangeDetector:
+    THUMBNAIL_SIZE = (32, 18)
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.current = None
+        self.previous = None
+        self.reference = None
+        self.score = 0.
+        self.motion = False
+        self.lastMotion = 0.
+
+    def thumbnail(self, data):
+        image = Image.open(BytesIO(data))
+        image.draft("L", (image.width // 8, image.height // 8))
+        image = image.convert("L").resize(self.THUMBNAIL_SIZE, Image.Resampling.BILINEAR)
+        return numpy.asarray(image, dtype=numpy.int16) if numpy is not None else image
+
+    # mean absolute luma difference, 0 - 255 - nothing to compare counts as no change
+    def difference(self, a, b):
+        if a is None or b is None: return 0.
+        if numpy is not None: return float(numpy.abs(a - b).mean())
+        return ImageStat.Stat(ImageChops.difference(a, b)).mean[0]
+
+    # compares a frame with the previous one - returns True when motion started or stopped.  The first frame
+    # is only the baseline, and a frame that can't be decoded neither counts as motion nor replaces the baseline.
+    def check(self, data):
+        try:
+            self.current = self.thumbnail(data)
+        except Exception:
+            self.current = None
+        self.score = self.difference(self.current, self.previous)
+        if self.current is not None: self.previous = self.current
+
+        now = time.time()
+        if self.score >= self.threshold:
+            self.lastMotion = now
+            if not self.motion:
+                self.motion = True
+                return True
+        elif self.motion and now > self.lastMotion + MOTION_HOLD:
+            self.motion = False
+            return True
+        return False
+
+    # whether the frame differs from the last one published - slow drift adds up
+    def changed(self):
+        if self.reference is None: return self.current is not None
+        return self.difference(self.current, self.reference) >= self.threshold
+
+    def published(self):
+        if self.current is not None: self.reference = self.current
+
+# Recent events for /?events subscribers, numbered so reconnecting clients can resume with Last-Event-ID
+class EventBus:
+    def __init__(self):
+        self.events = collections.deque(maxlen=64)
+        self.lastId = 0
+        self.closed = False
+        self.condition = threading.Condition()
+        self.subscribers = []
+
+    def publish(self, event):
+        with self.condition:
+            self.lastId = self.lastId + 1
+            self.events.append((self.lastId, event))
+            self.condition.notify_all()
+        for subscriber in self.subscribers:
+            subscriber()
+
+    def subscribe(self, callback):
+        self.subscribers = self.subscribers + [callback]
+
+    def unsubscribe(self, callback):
+        self.subscribers = [subscriber for subscriber in self.subscribers if subscriber != callback]
+
+    def since(self, lastId):
+        with self.condition:
+            return [(eventId, event) for eventId, event in self.events if eventId > lastId]
+
+    def wait(self, lastId, timeout=None):
+        with self.condition:
+            self.condition.wait_for(lambda: self.closed or self.lastId > lastId, timeout)
+        return self.since(lastId)
+
+    # wakes every subscriber so shutdown doesn't wait for their keep-alives
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        for subscriber in self.subscribers:
+            subscriber()
+
+def eventMessage(eventId, event):
+    return ("id: %d\nevent: motion\ndata: %s\n\n" % (eventId, json.dumps(event))).encode("utf-8")
+
+def lastEventId(headers, bus):
+    try:
+        lastId = int(headers.get("last-event-id", 0))
+    except ValueError:
+        return 0
+    # ids restart with the process
+    return lastId if lastId <= bus.lastId else 0
+
+# capped exponential backoff with jitter, so a farm of printers rebooting together doesn't reconnect in lockstep
+def backoffDelay(failures):
+    global myargs
+    return min(myargs.maxbackoff, BACKOFF_BASE * 2 ** (failures - 1)) * random.uniform(.5, 1.)
+
+# Recorder - appends the printer's original jpegs to segment files from a thread of its own, so recording
+# never decodes or encodes.  NAME.mjpeg is plain concatenated jpegs (ffplay / vlc play it as mjpeg) and
+# NAME.idx holds a fixed size (timestamp, offset, length) record per frame for seeking.
+INDEX_RECORD = struct.Struct("<dQI")
+SEGMENT_NAME = re.compile(r"^\d{8}-\d{6}(-\d+)?$")
+RECORDER_QUEUE = 64
+DOWNLOAD_CHUNK = 1024 * 1024
+
+class Recorder:
+    def __init__(self, camera, directory, maxBytes, maxSeconds, every=1, keep=0, writer=True):
+        self.camera = camera
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.maxSeconds = maxSeconds
+        self.every = every
+        self.keep = keep
+        self.count = 0
+        self.queue = queue.Queue(RECORDER_QUEUE)
+        self.data = None
+        self.index = None
+        self.segmentStart = 0.
+        self.offset = 0
+        self.recorded = FRAMES_RECORDED.labels(camera.name)
+        self.dropped = RECORDER_DROPS.labels(camera.name)
+        self.writer = writer
+
+        # --workers: only the capture process writes, the workers just serve the segments
+        if not writer: return
+
+        os.makedirs(directory, exist_ok=True)
+        camera.frameBus.subscribe(self.put)
+        self.thread = threading.Thread(target=self.run, name=camera.name + "-recorder", daemon=True)
+        self.thread.start()
+
+    # called on the capture thread - only queues, a slow disk costs recorded frames rather than live ones
+    def put(self, frame):
+        self.count = self.count + 1
+        if self.count % self.every: return
+        try:
+            self.queue.put_nowait(frame)
+        except queue.Full:
+            self.dropped.inc()
+
+    def stop(self):
+        if not self.writer: return
+        self.camera.frameBus.unsubscribe(self.put)
+        self.queue.put(None)
+
+    def run(self):
+        while True:
+            frame = self.queue.get()
+            if frame is None: break
+            try:
+                self.write(frame)
+            except OSError as e:
+                print(f"{datetime.datetime.now()}: {self.camera.name}: recording failed: [{e}]", flush=True)
+                self.closeSegment()
+        self.closeSegment()
+
+    def write(self, frame):
+        if self.data is None or self.offset + len(frame.data) > self.maxBytes or frame.timestamp >= self.segmentStart + self.maxSeconds:
+            self.closeSegment()
+            self.openSegment(frame.timestamp)
+
+        # unbuffered, and data before its index record, so readers never see an index entry past the end of the data
+        self.data.write(frame.data)
+        self.index.write(INDEX_RECORD.pack(frame.timestamp, self.offset, len(frame.data)))
+        self.offset = self.offset + len(frame.data)
+        self.recorded.inc()
+
+    def openSegment(self, timestamp):
+        name = base = time.strftime("%Y%m%d-%H%M%S", time.localtime(timestamp))
+        suffix = 0
+        while os.path.exists(os.path.join(self.directory, name + ".idx")):
+            suffix = suffix + 1
+            name = "%s-%d" % (base, suffix)
+
+        self.data = open(os.path.join(self.directory, name + ".mjpeg"), "wb", buffering=0)
+        self.index = open(os.path.join(self.directory, name + ".idx"), "wb", buffering=0)
+        self.segmentStart = timestamp
+        self.offset = 0
+        print(f"{datetime.datetime.now()}: {self.camera.name}: recording to {name}.mjpeg", flush=True)
+
+        if self.keep > 0:
+            for old in self.segments()[:-self.keep]:
+                for extension in (".idx", ".mjpeg"):
+                    try:
+                        os.remove(os.path.join(self.directory, old + extension))
+                    except FileNotFoundError:
+                        pass
+
+    def closeSegment(self):
+        if self.data is not None: self.data.close()
+        if self.index is not None: self.index.close()
+        self.data = None
+        self.index = None
+
+    # segment names, oldest first
+    def segments(self):
+        try:
+            entries = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted(name for name, extension in map(os.path.splitext, entries) if extension == ".idx" and SEGMENT_NAME.match(name))
+
+    # a segment by name, or the one recording at the given time, or the newest
+    def findSegment(self, name=None, at=None):
+        segments = self.segments()
+        if name is not None: return Segment(self.directory, name) if name in segments else None
+        if at is not None: segments = [segment for segment in segments if segmentTime(segment) <= at]
+        return Segment(self.directory, segments[-1]) if segments else None
+
+    def listing(self):
+        listing = []
+        for name in self.segments():
+            try:
+                with Segment(self.directory, name) as segment:
+                    listing.append(segment.summary())
+            except OSError:
+                pass
+        return listing
+
+def segmentTime(name):
+    return time.mktime(time.strptime(name[:15], "%Y%m%d-%H%M%S"))
+
+# A recorded segment opened for reading through mmap - frames are sliced straight out of the page cache
+class Segment:
+    def __init__(self, directory, name):
+        self.name = name
+        self.dataPath = os.path.join(directory, name + ".mjpeg")
+        self.indexPath = os.path.join(directory, name + ".idx")
+        self.index = None
+        self.data = None
+        self.frames = 0
+        self.length = 0
+
+    def __enter__(self):
+        # map the index first - the data file is always at least as long as the frames it lists
+        with open(self.indexPath, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            self.frames = size // INDEX_RECORD.size
+            if self.frames > 0: self.index = mmap.mmap(f.fileno(), self.frames * INDEX_RECORD.size, access=mmap.ACCESS_READ)
+        if self.frames > 0:
+            timestamp, offset, length = self.entry(self.frames - 1)
+            self.length = offset + length
+            with open(self.dataPath, "rb") as f:
+                self.data = mmap.mmap(f.fileno(), self.length, access=mmap.ACCESS_READ)
+        return self
+
+    def __exit__(self, *args):
+        if self.index is not None: self.index.close()
+        if self.data is not None: self.data.close()
+
+    def entry(self, index):
+        return INDEX_RECORD.unpack_from(self.index, index * INDEX_RECORD.size)
+
+    # frame number for ?frame= (negative counts from the end) or ?time=, None when the segment is empty
+    def locate(self, index=None, at=None):
+        if self.frames == 0: return None
+        if at is not None:
+            # the last frame captured at or before at
+            low, high = 0, self.frames
+            while low < high:
+                middle = (low + high) // 2
+                if self.entry(middle)[0] <= at: low = middle + 1
+                else: high = middle
+            index = low - 1
+        elif index is None:
+            index = 0
+        elif index < 0:
+            index = self.frames + index
+        return min(max(index, 0), self.frames - 1)
+
+    def read(self, index):
+        timestamp, offset, length = self.entry(index)
+        return timestamp, self.data[offset:offset + length]
+
+    def chunk(self, offset):
+        return self.data[offset:offset + DOWNLOAD_CHUNK]
+
+    def summary(self):
+        start, end = (self.entry(0)[0], self.entry(self.frames - 1)[0]) if self.frames > 0 else (0., 0.)
+        return {"name": self.name, "start": start, "end": end, "frames": self.frames, "bytes": self.length}
+
+# Shared memory frame ring for local consumers.  Layout, all little endian:
+#   header  magic "WEBCAMD1", version u32, slots u32, data size u64, latest seq u64, reserved u64, committed u64
+#   slots   seq u64, timestamp f64, position u64, length u32, pad u32 - frame seq lives in slot seq % slots
+#   data    frames back to back; a frame that doesn't fit before the end starts over at 0
+# Positions only ever grow - a frame lives at position % data size.  The writer bumps reserved before
+# overwriting data, so a reader holding a frame at position p still has valid bytes while reserved <= p + data size.
+RING_MAGIC = b"WEBCAMD1"
+RING_HEADER = struct.Struct("<8sIIQQQQ")
+RING_HEADER_SIZE = 64
+RING_SLOT = struct.Struct("<QdQI4x")
+RING_SLOTS = 64
+NOTIFY_MESSAGE = struct.Struct("<QdQI")
+
+class FrameRing:
+    def __init__(self, path, dataSize=0, slots=RING_SLOTS, create=False):
+        self.path = path
+        if create:
+            self.slots = slots
+            self.dataSize = dataSize
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                os.ftruncate(fd, RING_HEADER_SIZE + slots * RING_SLOT.size + dataSize)
+                self.map = mmap.mmap(fd, 0)
+            finally:
+                os.close(fd)
+            RING_HEADER.pack_into(self.map, 0, RING_MAGIC, 1, slots, dataSize, 0, 0, 0)
+        else:
+            with open(path, "rb") as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, version, self.slots, self.dataSize = RING_HEADER.unpack_from(self.map, 0)[:4]
+            if magic != RING_MAGIC: raise ValueError(f"{path} is not a webcamd frame ring")
+        self.dataStart = RING_HEADER_SIZE + self.slots * RING_SLOT.size
+        self.data = memoryview(self.map)[self.dataStart:]
+
+    def header(self):
+        return RING_HEADER.unpack_from(self.map, 0)
+
+    def latest(self):
+        return self.header()[4]
+
+    # writer side - returns the position the frame was stored at
+    def publish(self, seq, timestamp, data):
+        length = len(data)
+        if length > self.dataSize: raise ValueError(f"{length} byte frame does not fit a {self.dataSize} byte ring")
+
+        magic, version, slots, dataSize, latest, reserved, position = self.header()
+        if position % dataSize + length > dataSize: position = position + dataSize - position % dataSize
+
+        # reserve, write, then publish the slot and the sequence number last
+        struct.pack_into("<Q", self.map, 32, position + length)
+        offset = position % dataSize
+        self.data[offset:offset + length] = data
+        RING_SLOT.pack_into(self.map, RING_HEADER_SIZE + (seq % self.slots) * RING_SLOT.size, seq, timestamp, position, length)
+        struct.pack_into("<Q", self.map, 40, position + length)
+        struct.pack_into("<Q", self.map, 24, seq)
+        return position
+
+    # reader side - (timestamp, position, view) for a frame still in the ring, else None.  The view is zero
+    # copy, so check valid(position) again once done with it.
+    def frame(self, seq):
+        if seq == 0: return None
+        slotSeq, timestamp, position, length = RING_SLOT.unpack_from(self.map, RING_HEADER_SIZE + (seq % self.slots) * RING_SLOT.size)
+        if slotSeq != seq or not self.valid(position): return None
+        offset = position % self.dataSize
+        return timestamp, position, self.data[offset:offset + length]
+
+    def valid(self, position):
+        return self.header()[5] <= position + self.dataSize
+
+    # a private copy of the frame, or None if it was overwritten while copying
+    def copy(self, seq):
+        frame = self.frame(seq)
+        if frame is None: return None
+        timestamp, position, view = frame
+        data = bytes(view)
+        view.release()
+        return (timestamp, data) if self.valid(position) else None
+
+    def close(self, unlink=False):
+        self.data.release()
+        self.map.close()
+        if unlink:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+
+# Exports a camera's published frames to a FrameRing, optionally announcing each one on a unix socket
+# (NOTIFY_MESSAGE: seq, timestamp, position, length) so readers don't have to poll.
+class FrameExport:
+    def __init__(self, camera, path, dataSize, notify=False):
+        self.camera = camera
+        self.ring = FrameRing(path, dataSize, create=True)
+        self.seq = 0
+        self.clients = []
+        self.listener = None
+        self.exported = FRAMES_EXPORTED.labels(camera.name)
+
+        if notify:
+            self.socketPath = path + ".sock"
+            if os.path.exists(self.socketPath): os.unlink(self.socketPath)
+            self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.listener.bind(self.socketPath)
+            self.listener.listen()
+            threading.Thread(target=self.accept, name=camera.name + "-export", daemon=True).start()
+
+        camera.frameBus.subscribe(self.put)
+        print(f"{datetime.datetime.now()}: {camera.name}: exporting frames to {path}", flush=True)
+
+    def accept(self):
+        while True:
+            try:
+                client, address = self.listener.accept()
+            except OSError:
                 return
+            client.setblocking(False)
+            self.clients = self.clients + [client]
 
-            self.server.addSession()
+    # called on the capture thread - one copy into shared memory
+    def put(self, frame):
+        try:
+            self.seq = self.seq + 1
+            position = self.ring.publish(self.seq, frame.timestamp, frame.data)
+            self.exported.inc()
+        except ValueError as e:
+            print(f"{datetime.datetime.now()}: {self.camera.name}: export skipped: [{e}]", flush=True)
+            return
 
-            if rotate != -1: jpg = jpg.rotate(rotate) 
-            fpsFont = ImageFont.truetype("SourceCodePro-Regular.ttf", 14)
-            fmA, fmD = fpsFont.getmetrics()
-            fmD = fmD * -1 
+        if not self.clients: return
+        message = NOTIFY_MESSAGE.pack(self.seq, frame.timestamp, position, len(frame.data))
+        for client in self.clients:
+            try:
+                client.send(message)
+            except BlockingIOError:
+                # a reader that isn't keeping up can catch up from the ring header
+                pass
+            except OSError:
+                client.close()
+                self.clients = [other for other in self.clients if other is not client]
+
+    def close(self):
+        self.camera.frameBus.unsubscribe(self.put)
+        if self.listener is not None:
+            self.listener.close()
+            for client in self.clients: client.close()
+            os.unlink(self.socketPath)
+        self.ring.close(unlink=True)
+
+# --workers: the capture process and its http workers share frames through a FrameRing per printer, and
+# statistics through small json files that every process rewrites each second
+STATS_INTERVAL = 1.
+
+def clusterPrefix():
+    global myargs
+    return "/dev/shm/webcamd-%d" % (os.getpid() if myargs.worker is None else os.getppid())
 
-            draw = ImageDraw.Draw(jpg)
+def ringPath(name):
+    global myargs
+    if myargs.export is not None: return os.path.join(myargs.export, "webcamd-" + quote(name, safe=""))
+    return clusterPrefix() + "-" + quote(name, safe="")
 
-            message = f"{socket.getnameinfo((self.client_address[0], 0), 0)[0]}\n{datetime.datetime.now()}"            
+def workerStatsPath(worker):
+    return "%s.worker%d.json" % (clusterPrefix(), worker)
 
-            bbox = draw.textbbox((0, fmD), message, font=fpsFont)
-            draw.rectangle(bbox, fill="black")
-            draw.text((0, fmD), message, font=fpsFont)
+CLUSTER_ENTRY = re.compile(r"^webcamd-(\d+)(-.+|\.capture\.json|\.worker\d+\.json)(\.tmp)?$")
 
-            tmpFile = BytesIO()
-            jpg.save(tmpFile, "JPEG")
+# rings, sockets and stats files left behind by a capture process that was killed before it could clean up
+def removeStaleClusters():
+    for entry in os.listdir("/dev/shm"):
+        match = CLUSTER_ENTRY.match(entry)
+        if match is None: continue
+        try:
+            os.kill(int(match.group(1)), 0)
+            continue
+        except ProcessLookupError:
+            pass
+        except PermissionError:
+            continue
+        try:
+            os.remove(os.path.join("/dev/shm", entry))
+            print(f"{datetime.datetime.now()}: removed stale /dev/shm/{entry}", flush=True)
+        except OSError:
+            pass
+
+def localStats():
+    global cameras
+    return {camera.name: {"streamFps": camera.streamFps, "streamDrops": camera.streamDrops, "streamLatency": camera.streamLatency, "lagDisconnects": camera.lagDisconnects,
+                          "snapshots": camera.snapshots, "sessions": camera.getSessions(), "encodeFps": camera.getEncodeFps(),
+                          "connected": camera.connected, "motion": camera.motion} for camera in cameras.values()}
+
+def writeStats(path):
+    temporary = path + ".tmp"
+    with open(temporary, "w") as f:
+        json.dump({"cameras": localStats(), "metrics": metricState()}, f)
+    os.replace(temporary, path)
+
+def readStats(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
 
-            self.send_response(200)
-            self.send_header("Content-type", "image/jpeg")
-            self.send_header("Content-length", str(len(tmpFile.getvalue())))
-            self.end_headers()
+def statsWriter(path):
+    global webserver
+    while webserver is None or webserver.isRunning():
+        try:
+            writeStats(path)
+        except OSError as e:
+            print(f"{datetime.datetime.now()}: unable to write {path}: [{e}]", flush=True)
+        time.sleep(STATS_INTERVAL)
 
-            self.wfile.write(tmpFile.getvalue())
-        except Exception as e:
-            print(f"{datetime.datetime.now()}: error in snapshot: [{e}]", flush=True)
+# session statistics for /?info - with --workers summed over every worker's stats file
+def sessionStats(camera):
+    global myargs
 
-        self.server.dropSession()
+    if myargs.worker is None:
+        return camera.streamFps, camera.streamDrops, camera.streamLatency, camera.lagDisconnects, camera.snapshots
+
+    streamFps = {}
+    streamDrops = {}
+    streamLatency = {}
+    lagDisconnects = 0
+    snapshots = 0
+    ownPath = workerStatsPath(myargs.worker)
+    for path in glob.glob(clusterPrefix() + ".worker*.json"):
+        # our own numbers are fresher than the file
+        stats = localStats() if path == ownPath else readStats(path).get("cameras", {})
+        entry = stats.get(camera.name)
+        if entry is None: continue
+        streamFps.update(entry["streamFps"])
+        streamDrops.update(entry["streamDrops"])
+        streamLatency.update(entry["streamLatency"])
+        lagDisconnects = lagDisconnects + entry["lagDisconnects"]
+        snapshots = snapshots + entry["snapshots"]
+    return streamFps, streamDrops, streamLatency, lagDisconnects, snapshots
+
+def recordingsPage(camera):
+    return json.dumps({"camera": camera.name, "segments": camera.recorder.listing() if camera.recorder is not None else []})
 
 def web_server_thread():
     global exitCode
     global myargs
     global webserver
-    global encoderLock
-    global encodeFps
 
     try:
-        if myargs.ipv == 4:
+        if myargs.workers > 0 and myargs.worker is None:
+            webserver = CaptureSupervisor(myargs.workers)
+        elif myargs.server == "asyncio":
+            if myargs.ipv == 4:
+                webserver = AsyncHTTPServer((myargs.v4bindaddress, myargs.port))
+            else:
+                webserver = AsyncHTTPServer((myargs.v6bindaddress, myargs.port), socket.AF_INET6)
+        elif myargs.ipv == 4:
             webserver = ThreadingHTTPServer((myargs.v4bindaddress, myargs.port), WebRequestHandler)
         else:
             webserver = ThreadingHTTPServerV6((myargs.v6bindaddress, myargs.port), WebRequestHandler)
@@ -299,67 +1829,889 @@ def web_server_thread():
 
     print(f"{datetime.datetime.now()}: web server thread died", flush=True)
 
-class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+# Frame rendering and lifecycle shared by the threaded and asyncio front-ends
+class WebServer:
     running = True
-    sessions = 0
 
-    def __init__(self, mixin, server):
-        global encoderLock
-        encoderLock.acquire()
-        super().__init__(mixin, server)
+    def encodeOverlay(self, camera, frame, rotate, scale, showRed, streamKey, quality=None):
+        streamFps = camera.streamFps
+
+        # whole seconds so the text sprite is only re-rasterised once a second
+        message = f"{streamKey}\n{datetime.datetime.now().replace(microsecond=0)}\nEncode: {round(camera.getEncodeFps(), 1)} FPS"
+
+        if streamKey in streamFps:
+            message = message + f"\nStreams: {len(streamFps)} @ {round(streamFps[streamKey], 1)} FPS"
+
+        latency = camera.streamLatency.get(streamKey)
+        if latency:
+            message = message + f"\nLatency: p50 {round(latency['p50'])} / p95 {round(latency['p95'])} ms"
+
+        return frame.render(rotate, frame.fitSize(rotate, scale), message, showRed, quality)
+
+    # watermarked with the capture time rather than the client, so every poller shares one cached encode per frame
+    def encodeSnapshot(self, camera, frame, rotate, scale, quality=None):
+        if frame.isPassthrough(rotate, scale, quality): return frame.data
+        return frame.getVariant(rotate, scale, "snapshot", snapshotText(camera, frame), quality)
+
+    def isRunning(self):
+        return self.running
+    def stopCameras(self):
+        global cameras
+        for camera in cameras.values(): camera.stop()
+    def unlockEncoders(self):
+        global cameras
+        for camera in cameras.values(): camera.unlockEncoder()
+
+class ThreadingHTTPServer(WebServer, ThreadingMixIn, HTTPServer):
+    def server_bind(self):
+        global myargs
+        # --workers: every worker binds the same port and the kernel spreads connections across them
+        if myargs.workers > 0: self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
 
-    def getImage(self):
-        global lastImage
-        if not lastImage is None:
-            return lastImage.copy()
-        else:
-            return None
-        
     def die(self):
         super().shutdown()
         self.running = False
-    def isRunning(self):
-        return self.running
+        self.stopCameras()
+
+class ThreadingHTTPServerV6(ThreadingHTTPServer):
+        address_family = socket.AF_INET6
+
+# --workers: the capture process serves no http itself - it starts the workers, publishes capture statistics
+# for them and shuts down as soon as any of them exits (e.g. after /?shutdown)
+class CaptureSupervisor(WebServer):
+    def __init__(self, workers):
+        self.workers = workers
+        self.processes = []
+        self.stopped = threading.Event()
+
+    def serve_forever(self):
+        global exitCode
+
+        statsPath = clusterPrefix() + ".capture.json"
+        self.processes = [subprocess.Popen([sys.executable] + sys.argv + ["--worker", str(worker), "--snapshottag", SNAPSHOT_TAG]) for worker in range(self.workers)]
+        print(f"{datetime.datetime.now()}: started {self.workers} http workers", flush=True)
+
+        while not self.stopped.wait(STATS_INTERVAL):
+            writeStats(statsPath)
+            for process in self.processes:
+                code = process.poll()
+                if code is None: continue
+                print(f"{datetime.datetime.now()}: http worker {process.pid} exited with code {code}", flush=True)
+                if exitCode == os.EX_OK: exitCode = code if code > 0 else os.EX_SOFTWARE
+                self.die()
+                break
+
+        for process in self.processes:
+            if process.poll() is None: process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        for path in glob.glob(clusterPrefix() + ".*.json*"): os.remove(path)
+
+    def die(self):
+        self.running = False
+        self.stopCameras()
+        self.stopped.set()
+
+# Serves every client from a single event loop.  Sessions await frame notifications and write
+# through non-blocking transports, while decode / encode work is handed to the shared worker pool.
+class AsyncHTTPServer(WebServer):
+    def __init__(self, address, family=socket.AF_INET):
+        # bind up front so startup errors surface the same way they do for the threaded server
+        self.socket = socket.create_server(address, family=family, backlog=128, reuse_port=myargs.workers > 0)
+        self.loop = None
+        self.stopped = None
+        self.handlers = set()
+
+    def serve_forever(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        global cameras
+
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+
+        server = await asyncio.start_server(lambda reader, writer: AsyncRequestHandler(self, reader, writer).handle(), sock=self.socket)
+        try:
+            await self.stopped.wait()
+        finally:
+            server.close()
+            if self.handlers: await asyncio.wait(self.handlers, timeout=5)
+
+    def die(self):
+        self.running = False
+        self.stopCameras()
+        if self.loop is not None: self.loop.call_soon_threadsafe(self.stopped.set)
+
+    async def run(self, function, *args):
+        global workerPool
+        return await self.loop.run_in_executor(workerPool, function, *args)
+
+class AsyncRequestHandler:
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.client_address = writer.get_extra_info("peername")[:2]
+        self.requestline = ""
+        self.requestVersion = "HTTP/1.0"
+        self.path = ""
+        self.headers = {}
+        self.closeConnection = True
+
+    async def handle(self):
+        task = asyncio.current_task()
+        self.server.handlers.add(task)
+        try:
+            # keep-alive - serve requests until the client or a streaming response closes the connection
+            while self.server.isRunning():
+                self.path = ""
+                self.headers = {}
+                await asyncio.wait_for(self.readRequest(), KEEPALIVE_TIMEOUT)
+                if not self.path: break
+                await self.do_GET()
+                if self.closeConnection: break
+        except (ConnectionError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            print(f"{datetime.datetime.now()}: error handling {self.requestline} from {self.client_address[0]}:: [{e}]", flush=True)
+        finally:
+            self.writer.close()
+            self.server.handlers.discard(task)
+
+    async def readRequest(self):
+        self.requestline = (await self.reader.readline()).decode("latin-1").rstrip("\r\n")
+        words = self.requestline.split()
+
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b"\n", b""): break
+            key, _, value = line.decode("latin-1").partition(":")
+            self.headers[key.strip().lower()] = value.strip()
+
+        if len(words) < 2: return
+        self.requestVersion = words[2] if len(words) > 2 else "HTTP/0.9"
+        connection = self.headers.get("connection", "").lower()
+        if self.requestVersion == "HTTP/1.1":
+            self.closeConnection = connection == "close"
+        else:
+            self.closeConnection = connection != "keep-alive"
+
+        if words[0] != "GET":
+            self.closeConnection = True
+            await self.sendPage(501, "text/html", "Unsupported method (%s)" % words[0])
+            return
+        self.path = words[1]
+
+    async def do_GET(self):
+        global exitCode
+
+        camera, route, params = routeRequest(self.path)
+
+        if route in ("snapshot", "stream", "events"):
+            camera.touch()
+
+        if route == "snapshot":
+            camera.snapshots = camera.snapshots + 1
+            await self.sendSnapshot(camera, **params)
+            return
+
+        if route == "stream":
+            await self.streamVideo(camera, **params)
+            return
+
+        if route == "badrequest":
+            await self.sendPage(400, "text/html", "Invalid query string.")
+            return
+
+        if route == "info":
+            await self.sendPage(200, "text/json", infoPage(self.headers.get('host'), camera))
+            return
+
+        if route == "metrics":
+            await self.sendPage(200, "text/plain; version=0.0.4", metricsPage())
+            return
+
+        if route == "frame":
+            await self.sendPage(200, "text/html", framePage())
+            return
+
+        if route == "events":
+            await self.streamEvents(camera)
+            return
+
+        if route == "recordings":
+            await self.sendPage(200, "text/json", await self.server.run(recordingsPage, camera))
+            return
+
+        if route == "recording":
+            await self.sendRecording(camera, **params)
+            return
+
+        if route == "shutdown":
+            self.closeConnection = True
+            await self.sendPage(200, "text/html", shutdownPage())
+
+            client = ("%s:%d" % (self.client_address[0], self.client_address[1]))
+            print(f"{datetime.datetime.now()}: shutdown requested by {client}", flush=True)
+
+            exitCode = os.EX_TEMPFAIL
+            self.server.die()
+            self.server.unlockEncoders()
+            return
+
+        await self.sendPage(404, "text/html", indexPage(self.headers.get('host')))
+
+    def log_message(self, format, *args):
+        global myargs
+        if not myargs.loghttp: return
+        print(f"{datetime.datetime.now()}: {self.client_address[0]} {format % args}", flush=True)
+
+    def sendHeaders(self, status, headers):
+        self.log_message('"%s" %s -', self.requestline, status)
+        lines = ["HTTP/1.1 %d %s" % (status, HTTPStatus(status).phrase),
+                 "Server: webcamd",
+                 "Date: " + formatdate(usegmt=True)]
+        lines.extend("%s: %s" % header for header in headers)
+        if self.closeConnection:
+            lines.append("Connection: close")
+        elif self.requestVersion != "HTTP/1.1":
+            lines.append("Connection: keep-alive")
+        self.writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+
+    async def sendPage(self, status, contentType, page):
+        page = page.encode("utf-8")
+        self.sendHeaders(status, [("Content-type", contentType), ("Content-length", len(page))])
+        self.writer.write(page)
+        await self.writer.drain()
+
+    async def streamVideo(self, camera, rotate=-1, scale=None, showFps = False, fps=None, quality=None, websocket=False, ack=True):
+        global myargs
+
+        if websocket:
+            if not await self.acceptWebSocket(): return
+        else:
+            if camera.getFrame() is None and myargs.ondemand: await self.server.run(camera.waitFrame, 0, WARMUP_TIMEOUT)
+            if camera.getFrame() is None:
+                await self.sendPage(200, "text/html", loadingPage())
+                return
+
+            self.closeConnection = True
+            self.sendHeaders(200, [("Content-type", "multipart/x-mixed-replace; boundary=boundarydonotcross")])
+
+        frames = 0
+        camera.addSession()
+        streamKey = sessionName(self.client_address)
+        metrics = StreamMetrics(camera, streamKey)
+        slot = FrameSlot(camera.frameBus, self.server.loop)
+        self.writer.get_extra_info("socket").setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, STREAM_SEND_BUFFER)
+        self.writer.transport.set_write_buffer_limits(STREAM_SEND_BUFFER)
+
+        startTime = time.time()
+        primed = False
+        boundary = b"--boundarydonotcross\r\n"
+        lastData = None
+        lastSent = time.time()
+        lastTimestamp = 0.
+        frame = None
+
+        try:
+            while self.server.isRunning():
+                if time.time() > startTime + 5:
+                    name = sessionName(self.client_address)
+                    if name != streamKey:
+                        camera.renameSession(streamKey, name)
+                        metrics.rename(name)
+                        streamKey = name
+
+                    camera.streamFps[streamKey] = frames / 5.
+                    camera.streamDrops[streamKey] = metrics.droppedFrames
+                    camera.streamLatency[streamKey] = metrics.latency()
+                    frames = 0
+                    startTime = time.time()
+                    primed = True
+
+                frame = await slot.takeAsync(1.)
+                repeat = frame is None and lastData is not None and time.time() > lastSent + FRAME_KEEPALIVE and not websocket
+                if frame is None and not repeat: continue
+                if not repeat:
+                    if not frame.inBucket(fps):
+                        metrics.skipped(frame, slot.dropped)
+                        continue
+                    metrics.received(frame, slot.dropped)
+
+                    showRed = myargs.flashred and frame.flashPhase(fps)
+                    overlay = "flashred" if showRed else None
+
+                if repeat:
+                    data = lastData
+                elif showFps and primed:
+                    data = await self.server.run(self.server.encodeOverlay, camera, frame, rotate, scale, showRed, streamKey, quality)
+                else:
+                    data = frame.cachedVariant(rotate, scale, overlay, quality)
+                    if data is None: data = await self.server.run(functools.partial(frame.getVariant, rotate, scale, overlay, quality=quality))
+
+                if not repeat: lastTimestamp = frame.timestamp
+                if websocket:
+                    prefix = websocketHeader(WEBSOCKET_BINARY, len(data))
+                else:
+                    prefix = boundary + b"Content-type: image/jpeg\r\nContent-length: %d\r\nX-Timestamp: %.6f\r\n\r\n" % (len(data), lastTimestamp)
+                writeStart = time.perf_counter()
+                self.writer.writelines((prefix, data))
+                # a drain that takes longer than maxlag means the client has stopped reading
+                await asyncio.wait_for(self.writer.drain(), myargs.maxlag if myargs.maxlag > 0 else None)
+                lastData = data
+                lastSent = time.time()
+                if repeat: continue
+                metrics.sent(len(data), time.perf_counter() - writeStart, lastSent - frame.timestamp)
+
+                boundary = b"\r\n--boundarydonotcross\r\n"
+                frames = frames + 1
+
+                # how long the frame waited on this session, not its age - the first frame may be from before an outage or idle period
+                lag = time.time() - slot.arrivedAt
+                if myargs.maxlag > 0 and lag > myargs.maxlag:
+                    camera.lagged(streamKey, lag)
+                    break
+
+                if websocket and ack and not await asyncio.wait_for(self.waitWebSocketAck(), myargs.maxlag if myargs.maxlag > 0 else None): break
+        except asyncio.TimeoutError:
+            camera.lagged(streamKey, time.time() - (slot.arrivedAt if frame is not None else lastSent))
+        except ConnectionError:
+            pass
+        except Exception as e:
+            print(f"{datetime.datetime.now()}: error in stream {streamKey}:: [{e}]", flush=True)
+        finally:
+            if streamKey in camera.streamFps: camera.streamFps.pop(streamKey)
+            if streamKey in camera.streamDrops: camera.streamDrops.pop(streamKey)
+            if streamKey in camera.streamLatency: camera.streamLatency.pop(streamKey)
+            slot.close()
+            metrics.close()
+            camera.dropSession()
+
+    async def acceptWebSocket(self):
+        key = self.headers.get("sec-websocket-key")
+        if self.headers.get("upgrade", "").lower() != "websocket" or key is None:
+            self.closeConnection = True
+            await self.sendPage(400, "text/html", "Expected a websocket upgrade.")
+            return False
+
+        self.closeConnection = False
+        self.sendHeaders(101, [("Upgrade", "websocket"), ("Connection", "Upgrade"), ("Sec-WebSocket-Accept", websocketAccept(key))])
+        self.closeConnection = True
+        return True
+
+    async def waitWebSocketAck(self):
+        while True:
+            opcode, payload = await readWebSocketMessageAsync(self.reader)
+            if opcode == WEBSOCKET_PING:
+                self.writer.writelines((websocketHeader(WEBSOCKET_PONG, len(payload)), payload))
+            elif opcode == WEBSOCKET_CLOSE:
+                self.writer.write(websocketHeader(WEBSOCKET_CLOSE, 0))
+                return False
+            elif opcode in (WEBSOCKET_TEXT, WEBSOCKET_BINARY):
+                return True
+
+    async def streamEvents(self, camera):
+        self.closeConnection = True
+        self.sendHeaders(200, [("Content-type", "text/event-stream"), ("Cache-Control", "no-cache")])
+
+        wake = asyncio.Event()
+        loop = self.server.loop
+        subscriber = lambda: loop.call_soon_threadsafe(wake.set)
+        camera.events.subscribe(subscriber)
+        camera.addSession()
+
+        try:
+            lastId = lastEventId(self.headers, camera.events)
+            if lastId == 0:
+                lastId = camera.events.lastId
+                self.writer.write(eventMessage(lastId, camera.motionEvent()))
+
+            while self.server.isRunning() and not camera.events.closed:
+                wake.clear()
+                events = camera.events.since(lastId)
+                if not events:
+                    try:
+                        await asyncio.wait_for(wake.wait(), EVENT_KEEPALIVE)
+                    except asyncio.TimeoutError:
+                        self.writer.write(b": keep-alive\n\n")
+                    events = camera.events.since(lastId)
+                for eventId, event in events:
+                    self.writer.write(eventMessage(eventId, event))
+                    lastId = eventId
+                await self.writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            camera.events.unsubscribe(subscriber)
+            camera.dropSession()
+
+    async def sendSnapshot(self, camera, rotate=-1, scale=None, quality=None):
+        global myargs
+
+        frame = camera.getFrame()
+        if frame is None and myargs.ondemand: frame = await self.server.run(camera.waitFrame, 0, WARMUP_TIMEOUT)
+
+        if frame is None:
+            await self.sendPage(425, "text/html", "The server is not yet ready to serve requests.  Please try again momentarily.")
+            return
+
+        camera.addSession()
+
+        try:
+            etag, lastModified = snapshotValidators(frame)
+            validators = [("ETag", etag), ("Last-Modified", lastModified), ("Cache-Control", "no-cache")]
+
+            if notModified(self.headers, frame, etag):
+                self.sendHeaders(304, validators)
+            else:
+                data = frame.data if frame.isPassthrough(rotate, scale, quality) else frame.cachedVariant(rotate, scale, "snapshot", quality)
+                if data is None: data = await self.server.run(self.server.encodeSnapshot, camera, frame, rotate, scale, quality)
+
+                self.sendHeaders(200, [("Content-type", "image/jpeg"), ("Content-length", len(data))] + validators)
+                self.writer.write(data)
+            await self.writer.drain()
+        except ConnectionError:
+            self.closeConnection = True
+        except Exception as e:
+            self.closeConnection = True
+            print(f"{datetime.datetime.now()}: error in snapshot: [{e}]", flush=True)
+        finally:
+            camera.dropSession()
+
+    async def sendRecording(self, camera, name=None, index=None, at=None):
+        segment = camera.recorder.findSegment(name, at) if camera.recorder is not None else None
+        if segment is None:
+            await self.sendPage(404, "text/html", "No such recording.")
+            return
+
+        try:
+            with segment:
+                if index is None and at is None:
+                    self.sendHeaders(200, [("Content-type", "video/x-motion-jpeg"), ("Content-length", segment.length),
+                                           ("Content-Disposition", 'inline; filename="%s.mjpeg"' % segment.name)])
+                    for offset in range(0, segment.length, DOWNLOAD_CHUNK):
+                        # page faults on a cold segment would stall the event loop
+                        self.writer.write(await self.server.run(segment.chunk, offset))
+                        await self.writer.drain()
+                    return
+
+                index = segment.locate(index, at)
+                if index is None:
+                    await self.sendPage(404, "text/html", "No such recording.")
+                    return
+
+                timestamp, data = await self.server.run(segment.read, index)
+                self.sendHeaders(200, [("Content-type", "image/jpeg"), ("Content-length", len(data)), ("X-Timestamp", "%.6f" % timestamp),
+                                       ("X-Frame", index), ("Last-Modified", formatdate(timestamp, usegmt=True))])
+                self.writer.write(data)
+                await self.writer.drain()
+        except ConnectionError:
+            self.closeConnection = True
+        except Exception as e:
+            self.closeConnection = True
+            print(f"{datetime.datetime.now()}: error in recording {segment.name}: [{e}]", flush=True)
+
+# A single printer: its capture pipeline, frame bus and session statistics
+class Camera:
+    def __init__(self, name, hostname, password, rotate=-1):
+        self.name = name
+        self.hostname = hostname
+        self.password = password
+        self.rotate = rotate
+        self.frameBus = FrameBus()
+        self.encoderLock = threading.Lock()
+        self.encoderLock.acquire()
+        self.encodeFps = 0.0
+        self.streamFps = {}
+        self.streamDrops = {}
+        self.streamLatency = {}
+        self.lagDisconnects = 0
+        self.snapshots = 0
+        self.sessions = 0
+        self.connected = False
+        self.lastActivity = float("-inf")
+        self.demand = threading.Event()
+        self.stopped = threading.Event()
+        self.motion = False
+        self.events = EventBus()
+        self.recorder = None
+        self.export = None
+
+    def getFrame(self):
+        return self.frameBus.getFrame()
+    def waitFrame(self, version, timeout=None):
+        return self.frameBus.waitFrame(version, timeout)
+    def renameSession(self, streamKey, name):
+        if streamKey in self.streamFps: self.streamFps[name] = self.streamFps.pop(streamKey)
+        if streamKey in self.streamDrops: self.streamDrops[name] = self.streamDrops.pop(streamKey)
+        if streamKey in self.streamLatency: self.streamLatency[name] = self.streamLatency.pop(streamKey)
+    def lagged(self, streamKey, lag):
+        self.lagDisconnects = self.lagDisconnects + 1
+        LAG_DISCONNECTS.labels(self.name).inc()
+        print(f"{datetime.datetime.now()}: {self.name}: disconnecting {streamKey} - {lag:.1f} seconds behind", flush=True)
+    def touch(self):
+        self.lastActivity = time.monotonic()
+        self.demand.set()
+    def isIdle(self):
+        global myargs
+        # a recording or exporting printer is never idle
+        return self.sessions == 0 and self.recorder is None and self.export is None and time.monotonic() > self.lastActivity + myargs.idletimeout
     def addSession(self):
-        global encoderLock
-        if self.sessions == 0 and encoderLock.locked(): encoderLock.release()
+        if self.sessions == 0 and self.encoderLock.locked(): self.encoderLock.release()
         self.sessions = self.sessions + 1
+        self.touch()
     def dropSession(self):
-        global encoderLock
-        global encodeFps
-        global streamFps
+        self.lastActivity = time.monotonic()
         self.sessions = self.sessions - 1
-        if self.sessions == 0 and not encoderLock.locked():
-            encoderLock.acquire()
-            encodeFps = 0.0
-            streamFps = {}
+        if self.sessions == 0 and not self.encoderLock.locked():
+            self.encoderLock.acquire()
+            self.encodeFps = 0.0
+            self.streamFps = {}
+            self.streamDrops = {}
+            self.streamLatency = {}
     def unlockEncoder(self):
-        global encoderLock
-        if encoderLock.locked(): encoderLock.release()
+        if self.encoderLock.locked(): self.encoderLock.release()
     def getSessions(self):
         return self.sessions
     def getEncodeFps(self):
-        global encodeFps
-        return encodeFps
+        return self.encodeFps
+
+    def stop(self):
+        self.stopped.set()
+        self.frameBus.close()
+        self.events.close()
+        if self.recorder is not None: self.recorder.stop()
+        if self.export is not None: self.export.close()
+
+    def motionChanged(self, detector):
+        self.motion = detector.motion
+        MOTION.labels(self.name).value = 1 if detector.motion else 0
+        print(f"{datetime.datetime.now()}: {self.name}: motion {'started' if detector.motion else 'stopped'}", flush=True)
+        self.events.publish(self.motionEvent(detector.score))
+
+    def motionEvent(self, score=0.):
+        return {"camera": self.name, "motion": self.motion, "score": round(score, 2), "time": time.time()}
+
+    # --ondemand: block until a client wants frames from this printer
+    def waitDemand(self):
+        global webserver
+        while not webserver is None and webserver.isRunning():
+            self.demand.clear()
+            if not self.isIdle(): return True
+            self.demand.wait(1.)
+        return False
+
+    # --workers: take frames from the capture process's ring instead of the printer
+    def follow(self):
+        global webserver
+
+        path = ringPath(self.name)
+        capturePath = clusterPrefix() + ".capture.json"
+        sock = None
+        ring = None
+
+        while sock is None and not webserver is None and webserver.isRunning():
+            try:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.connect(path + ".sock")
+                ring = FrameRing(path)
+            except OSError:
+                # the capture process is still starting up
+                sock.close()
+                sock = None
+                time.sleep(.1)
+        if sock is None: return
+
+        sock.settimeout(STATS_INTERVAL)
+        pending = b""
+        lastSync = 0.
+
+        while not webserver is None and webserver.isRunning():
+            if time.time() > lastSync + STATS_INTERVAL:
+                lastSync = time.time()
+                self.syncCapture(readStats(capturePath).get("cameras", {}).get(self.name))
 
-class ThreadingHTTPServerV6(ThreadingHTTPServer):
-        address_family = socket.AF_INET6
+            try:
+                chunk = sock.recv(NOTIFY_MESSAGE.size * RING_SLOTS)
+            except socket.timeout:
+                continue
+            except OSError:
+                chunk = b""
+            if not chunk:
+                print(f"{datetime.datetime.now()}: {self.name}: capture process went away", flush=True)
+                webserver.die()
+                break
+
+            # only the newest announcement matters - older frames would be skipped by every session anyway
+            pending = pending + chunk
+            count = len(pending) // NOTIFY_MESSAGE.size
+            if count == 0: continue
+            seq = NOTIFY_MESSAGE.unpack_from(pending, (count - 1) * NOTIFY_MESSAGE.size)[0]
+            pending = pending[count * NOTIFY_MESSAGE.size:]
+
+            frame = ring.copy(seq)
+            # numbered like the ring so every worker gives the same frame the same etag
+            if frame is not None: self.frameBus.publish(frame[1], frame[0], seq)
+
+        sock.close()
+        if ring is not None: ring.close()
+
+    def syncCapture(self, stats):
+        if stats is None: return
+        self.encodeFps = stats["encodeFps"]
+        self.connected = stats["connected"]
+        if stats["motion"] != self.motion:
+            self.motion = stats["motion"]
+            self.events.publish(self.motionEvent())
+
+    def capture(self):
+        global exitCode
+        global myargs
+        global webserver
+
+        readSeconds = TLS_READ_SECONDS.labels(self.name)
+        assemblySeconds = ASSEMBLY_SECONDS.labels(self.name)
+        published = FRAMES_PUBLISHED.labels(self.name)
+        throttled = FRAMES_DISCARDED.labels(self.name, "throttled")
+        corrupt = FRAMES_DISCARDED.labels(self.name, "corrupt")
+        unchanged = FRAMES_DISCARDED.labels(self.name, "unchanged")
+        reconnects = RECONNECTS.labels(self.name)
+        connected = False
+
+        detector = ChangeDetector(myargs.motionthreshold) if myargs.motion or myargs.dedupe > 0 else None
+
+        frames = 0
+        startTime = time.time()
+
+        username = 'bblp'
+        access_code = self.password
+        hostname = self.hostname
+        port = 6000
+
+        MAX_READ_TIMEOUTS    = 10
+
+        auth_data = bytearray()
+        failures = 0
+        read_timeouts = 0
+
+        auth_data += struct.pack("<I", 0x40)   # '@'\0\0\0
+        auth_data += struct.pack("<I", 0x3000) # \0'0'\0\0
+        auth_data += struct.pack("<I", 0)      # \0\0\0\0
+        auth_data += struct.pack("<I", 0)      # \0\0\0\0
+        for i in range(0, len(username)):
+            auth_data += struct.pack("<c", username[i].encode('ascii'))
+        for i in range(0, 32 - len(username)):
+            auth_data += struct.pack("<x")
+        for i in range(0, len(access_code)):
+            auth_data += struct.pack("<c", access_code[i].encode('ascii'))
+        for i in range(0, 32 - len(access_code)):
+            auth_data += struct.pack("<x")
+
+        ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        ctx.check_hostname = False
+        ctx.verify_mode = ssl.CERT_NONE
+        # resumed on reconnect so a flapping printer link costs an abbreviated handshake
+        session = None
+
+        jpeg_start = bytearray([0xff, 0xd8, 0xff, 0xe0])
+        jpeg_end = bytearray([0xff, 0xd9])
+
+        lastChecked = 0.
+        lastPublished = 0.
+
+        # Payload format for each image is:
+        # 16 byte header:
+        #   Bytes 0:3   = little endian payload size for the jpeg image (does not include this header).
+        #   Bytes 4:7   = 0x00000000
+        #   Bytes 8:11  = 0x00000001
+        #   Bytes 12:15 = 0x00000000
+        #
+        # Bytes 16:19                       = jpeg_start magic bytes
+        # Bytes 20:payload_size-2           = jpeg image bytes
+        # Bytes payload_size-2:payload_size = jpeg_end magic bytes
+        #
+        # TLS record boundaries do not line up with the header or payload, so FrameReader reassembles the stream.
+        #
+        # The link is supervised rather than given up on: failed or dropped connections are retried with capped
+        # exponential backoff and jitter for as long as the server runs, while stream sessions stay connected and
+        # keep being sent the last frame.
+        while not webserver is None and webserver.isRunning():
+            if myargs.ondemand and not self.waitDemand(): break
+
+            if failures > 0:
+                delay = backoffDelay(failures)
+                print(f"{datetime.datetime.now()}: {self.name}: reconnecting in {delay:.1f} seconds", flush=True)
+                if self.stopped.wait(delay): break
+
+            idle = False
+
+            try:
+                print(f"{datetime.datetime.now()}: {self.name}: creating socket", flush=True)
+                with socket.create_connection((hostname, port), timeout=CONNECT_TIMEOUT) as sock:
+                    if connected: reconnects.inc()
+                    connected = True
+                    sslSock = ctx.wrap_socket(sock, server_hostname=hostname, session=session)
+                    if sslSock.session_reused: print(f"{datetime.datetime.now()}: {self.name}: resumed TLS session", flush=True)
+                    sslSock.write(auth_data)
+
+                    status = sslSock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    if status != 0:
+                        raise Exception(f"Socket error: {status}")
+
+                    sslSock.setblocking(False)
+                    self.connected = True
+                    receiving = False
+                    with FrameReader(sslSock) as reader:
+                        read_timeouts = 0
+
+                        while not webserver is None and webserver.isRunning() and read_timeouts < MAX_READ_TIMEOUTS:
+                            if myargs.ondemand and self.isIdle():
+                                # the last frame stays on the bus so the next client gets a picture straight away
+                                print(f"{datetime.datetime.now()}: {self.name}: idle for {myargs.idletimeout} seconds - disconnecting", flush=True)
+                                self.encodeFps = 0.0
+                                connected = False
+                                idle = True
+                                break
+
+                            if  time.time() > startTime + 5:
+                                self.encodeFps = frames / 5.
+                                if self.encodeFps <= 0: self.encodeFps = 1
+                                # if myargs.showfps: print("%s: encoding @ %.2f FPS - wait time %.5f" % (datetime.datetime.now(), self.encodeFps, myargs.encodewait), flush=True)
+                                frames = 0
+                                startTime = time.time()
+
+                            try:
+                                img = reader.readFrame(1.)
+                            except EOFError:
+                                # This occurs if the wrong access code was provided.
+                                if not receiving: print(f"{datetime.datetime.now()}: {self.name}: no data received - possible invalid access code provided", flush=True)
+                                else: print(f"{datetime.datetime.now()}: {self.name}: connection closed by printer", flush=True)
+                                break
+
+                            if img is None:
+                                read_timeouts = read_timeouts + 1
+                                continue
+
+                            if not receiving:
+                                # the link works - start the backoff over and keep the session (tls 1.3 tickets arrive after the handshake)
+                                receiving = True
+                                failures = 0
+                                session = sslSock.session
+                            read_timeouts = 0
+
+                            readSeconds.observe(reader.frameReadSeconds)
+                            assemblySeconds.observe(reader.frameAssemblySeconds)
+
+                            if img[:4] != jpeg_start:
+                                print(f"{datetime.datetime.now()}: {self.name}: JPEG start magic bytes missing", flush=True)
+                                corrupt.inc()
+                            elif img[-2:] != jpeg_end:
+                                print(f"{datetime.datetime.now()}: {self.name}: JPEG end magic bytes missing", flush=True)
+                                corrupt.inc()
+                            elif time.time() >= lastChecked + myargs.encodewait:
+                                # keep draining the socket, but only look at one frame per encodewait
+                                lastChecked = time.time()
+
+                                if detector is not None and detector.check(img) and myargs.motion: self.motionChanged(detector)
+
+                                if myargs.dedupe > 0 and not detector.changed() and lastChecked < lastPublished + myargs.dedupe:
+                                    # nothing moved - only publish a keep-alive frame every dedupe seconds
+                                    unchanged.inc()
+                                    continue
+
+                                lastPublished = lastChecked
+                                self.frameBus.publish(img, reader.completedAt)
+                                if detector is not None: detector.published()
+                                published.inc()
+                                frames = frames + 1.0
+                                if self.encoderLock.locked() and not myargs.ondemand and not myargs.motion and self.recorder is None and self.export is None:
+                                    self.encoderLock.acquire()
+                                    self.encoderLock.release()
+                            else:
+                                throttled.inc()
+
+                        if read_timeouts >= MAX_READ_TIMEOUTS: print(f"{datetime.datetime.now()}: {self.name}: no frames for {MAX_READ_TIMEOUTS} seconds", flush=True)
+
+            # except KeyboardInterrupt:
+            #     print(f"{datetime.datetime.now()}: {self.name}: shutdown requested", flush=True)
+            #     sslSock.shutdown(socket.SHUT_RDWR)
+            #     break
+
+            except ConnectionResetError:
+                print(f"{datetime.datetime.now()}: {self.name}: Connection Reset", flush=True)
+
+            except FrameError as e:
+                print(f"{datetime.datetime.now()}: {self.name}: Frame Error: [{e}]", flush=True)
+
+            except OSError as e:
+                # refused, unreachable, timed out or a failed handshake - the printer is probably rebooting
+                print(f"{datetime.datetime.now()}: {self.name}: connection failed: [{e}]", flush=True)
+
+            except Exception as e:
+                print(f"{datetime.datetime.now()}: {self.name}: {traceback.format_exc()}", flush=True)
+
+            finally:
+                self.connected = False
+
+            if not idle: failures = failures + 1
+
+# systemd stops us with SIGTERM - shut down like /?shutdown does so shared memory and stats files are removed
+def exit_gracefully(signum, frame):
+    global webserver
+
+    print(f"{datetime.datetime.now()}: {signal.Signals(signum).name} received - shutting down", flush=True)
+    if webserver is not None and webserver.isRunning():
+        webserver.die()
+        webserver.unlockEncoders()
 
 def main():
     global exitCode
+    global SNAPSHOT_TAG
     global myargs
     global webserver
-    global lastImage
-    global encoderLock
-    global encodeFps
+    global workerPool
+    global workerProcesses
+    global compositor
+    global hostNames
+    global cameras
 
-    # signal.signal(signal.SIGTERM, exit_gracefully)
+    signal.signal(signal.SIGTERM, exit_gracefully)
 
     # set_start_method('fork')
 
     parseArgs()
 
-    encoderLock = threading.Lock()
+    for printer in myargs.printers:
+        cameras[printer["name"]] = Camera(printer["name"], printer["hostname"], printer["password"], printer.get("rotate", myargs.rotate))
+
+    worker = myargs.worker is not None
+    if myargs.snapshottag is not None: SNAPSHOT_TAG = myargs.snapshottag
+    if myargs.workers > 0 and not worker and os.path.isdir("/dev/shm"): removeStaleClusters()
+
+    if myargs.record is not None:
+        for camera in cameras.values():
+            camera.recorder = Recorder(camera, os.path.join(myargs.record, quote(camera.name, safe="")), int(myargs.segmentsize * 1024 * 1024),
+                                       myargs.segmentseconds, myargs.timelapse, myargs.recordkeep, not worker)
+
+    # with --workers the capture process always exports - it is how the workers get their frames
+    if (myargs.export is not None or myargs.workers > 0) and not worker:
+        for camera in cameras.values():
+            camera.export = FrameExport(camera, ringPath(camera.name), int(myargs.exportsize * 1024 * 1024), myargs.exportsocket or myargs.workers > 0)
+
+    if worker:
+        threading.Thread(target=statsWriter, args=(workerStatsPath(myargs.worker),), daemon=True).start()
+
+    compositor = OverlayCompositor()
+    hostNames = HostNameCache(myargs.dnsttl, not myargs.nodns)
+    workerPool = concurrent.futures.ThreadPoolExecutor(thread_name_prefix="webcamd")
+    if myargs.processes > 0:
+        workerProcesses = concurrent.futures.ProcessPoolExecutor(max_workers=myargs.processes, initializer=initWorker)
     threading.Thread(target=web_server_thread).start()
     # Process(target=web_server_thread).start()
 
@@ -367,156 +2719,16 @@ def main():
     while webserver is None and exitCode == os.EX_OK:
         time.sleep(.01)
 
-    frames = 0
-    startTime = time.time()
-
-    username = 'bblp'
-    access_code = myargs.password
-    hostname = myargs.hostname
-    port = 6000
-
-    MAX_CONNECT_ATTEMPTS = 3
-    MAX_READ_TIMEOUTS    = 10
-
-    auth_data = bytearray()
-    connect_attempts = 0
-    read_timeouts = 0
-
-    auth_data += struct.pack("<I", 0x40)   # '@'\0\0\0
-    auth_data += struct.pack("<I", 0x3000) # \0'0'\0\0
-    auth_data += struct.pack("<I", 0)      # \0\0\0\0
-    auth_data += struct.pack("<I", 0)      # \0\0\0\0
-    for i in range(0, len(username)):
-        auth_data += struct.pack("<c", username[i].encode('ascii'))
-    for i in range(0, 32 - len(username)):
-        auth_data += struct.pack("<x")
-    for i in range(0, len(access_code)):
-        auth_data += struct.pack("<c", access_code[i].encode('ascii'))
-    for i in range(0, 32 - len(access_code)):
-        auth_data += struct.pack("<x")
-
-    ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
-    ctx.check_hostname = False
-    ctx.verify_mode = ssl.CERT_NONE
-
-    jpeg_start = bytearray([0xff, 0xd8, 0xff, 0xe0])
-    jpeg_end = bytearray([0xff, 0xd9])
-
-    read_chunk_size = 4096 # 4096 is the max we'll get even if we increase this.
-
-    # Payload format for each image is:
-    # 16 byte header:
-    #   Bytes 0:3   = little endian payload size for the jpeg image (does not include this header).
-    #   Bytes 4:7   = 0x00000000
-    #   Bytes 8:11  = 0x00000001
-    #   Bytes 12:15 = 0x00000000
-    # These first 16 bytes are always delivered by themselves.
-    #
-    # Bytes 16:19                       = jpeg_start magic bytes
-    # Bytes 20:payload_size-2           = jpeg image bytes
-    # Bytes payload_size-2:payload_size = jpeg_end magic bytes
-    #
-    # Further attempts to receive data will get SSLWantReadError until a new image is ready (1-2 seconds later)
-    while connect_attempts < MAX_CONNECT_ATTEMPTS and not webserver is None and webserver.isRunning():
-        try:
-            print(f"{datetime.datetime.now()}: creating socket", flush=True)
-            with socket.create_connection((hostname, port)) as sock:
-                connect_attempts += 1
-                sslSock = ctx.wrap_socket(sock, server_hostname=hostname)
-                sslSock.write(auth_data)
-                img = None
-                payload_size = 0
-
-                status = sslSock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
-                if status != 0:
-                    raise Exception(f"Socket error: {status}")
-
-                sslSock.setblocking(False)
-                # sslSock.settimeout(10.0)
-                read_timeouts = 0
-
-                while not webserver is None and webserver.isRunning() and read_timeouts < MAX_READ_TIMEOUTS:
-                    if  time.time() > startTime + 5:
-                        encodeFps = frames / 5.
-                        if encodeFps <= 0: encodeFps = 1
-                        myargs.streamwait = 1 / encodeFps
-                        # if myargs.showfps: print("%s: encoding @ %.2f FPS - wait time %.5f" % (datetime.datetime.now(), encodeFps, myargs.encodewait), flush=True)
-                        frames = 0
-                        startTime = time.time()
-                        # dr = 0
-
-                    try:
-                        dr = sslSock.recv(read_chunk_size)
-                    except (TimeoutError, ssl.SSLWantReadError) as e:
-                        time.sleep(1)
-                        # print(f"{datetime.datetime.now()}: socket read timeout", flush=True)
-                        read_timeouts = read_timeouts + 1
-                        continue
-
-                    if img is not None and len(dr) > 0:
-                        img += dr
-                        if len(img) > payload_size:
-                            print(f"{datetime.datetime.now()}: We got more data than we expected", flush=True)
-                            img = None
-                        elif len(img) == payload_size:
-                            # We should have the full image now.
-                            if img[:4] != jpeg_start:
-                                print(f"{datetime.datetime.now()}: JPEG start magic bytes missing", flush=True)
-                            elif img[-2:] != jpeg_end:
-                                print(f"{datetime.datetime.now()}: JPEG end magic bytes missing", flush=True)
-                            else:
-                                read_timeouts = 0
-                                lastImage = Image.open(io.BytesIO(img)).convert('RGB')
-                                frames = frames + 1.0
-                                if encoderLock.locked():
-                                    encoderLock.acquire()
-                                    encoderLock.release()
-                            # Reset buffer
-                            img = None
-                            time.sleep(myargs.encodewait)
-                        # else:     
-                        # Otherwise we need to continue looping without reseting the buffer to receive the remaining data
-                        # and without delaying.
-
-                    elif len(dr) == 16:
-                        # We got the header bytes. Get the expected payload size from it and create the image buffer bytearray.
-                        # Reset connect_attempts now we know the connect was successful.
-                        connect_attempts = 0
-                        img = bytearray()
-                        payload_size = int.from_bytes(dr[0:3], byteorder='little')
-
-                    elif len(dr) == 0:
-                        # This occurs if the wrong access code was provided.
-                        # LOGGER.error(f"{self._client._device.info.device_type}: Chamber image connection rejected by the printer. Check provided access code and IP address.")
-                        # Sleep for a short while and then re-attempt the connection.
-                        time.sleep(1)
-                        print(f"{datetime.datetime.now()}: no data received - possible invalid access code provided", flush=True)
-                        read_timeouts = read_timeouts + 1
-                        continue
-
-                    else:
-                        # print("unexpected error")
-                        # time.sleep(1)
-                        # raise Exception("unknown error occurred")
-                        print(f"{datetime.datetime.now()}: unknown error occurred", flush=True)
-
-        # except KeyboardInterrupt:
-        #     print(f"{datetime.datetime.now()}: shutdown requested", flush=True)
-        #     sslSock.shutdown(socket.SHUT_RDWR)
-        #     break
-
-        except ConnectionResetError:
-            print(f"{datetime.datetime.now()}: Connection Reset", flush=True)
-            
-        except Exception as e:
-            print(f"{datetime.datetime.now()}: {traceback.format_exc()}", flush=True)
-            exitCode = os.EX_TEMPFAIL
-            break
+    captureThreads = [threading.Thread(target=camera.follow if worker else camera.capture, name=camera.name) for camera in cameras.values()]
+    for thread in captureThreads: thread.start()
+    for thread in captureThreads: thread.join()
 
     if not webserver is None and webserver.isRunning():
         print(f"{datetime.datetime.now()}: web server shutting down", flush=True)
         webserver.die()
 
+    if workerProcesses is not None: workerProcesses.shutdown(cancel_futures=True)
+
     time.sleep(1)
 
     print(f"{datetime.datetime.now()}: ExitCode={exitCode} - Goodbye!", flush=True)
@@ -532,26 +2744,37 @@ def parseArgs():
     parser.add_argument(
         "--hostname",
         type=str,
-        required=True,
         help="Bambu Printer IP address / hostname"
     )
     parser.add_argument(
         "--password",
         type=str,
-        required=True,
         help="Bambu Printer Access Code"
     )
+    parser.add_argument(
+        "--printer",
+        type=str,
+        action="append",
+        default=[],
+        metavar="NAME=HOSTNAME:ACCESSCODE",
+        help="serve an additional printer at /cam/NAME/ - may be repeated"
+    )
+    parser.add_argument(
+        "--config",
+        type=str,
+        help="json file listing printers as [{\"name\": ..., \"hostname\": ..., \"password\": ..., \"rotate\": ...}]"
+    )
     parser.add_argument(
         "--width",
         type=int,
         default=1920,
-        help="web camera pixel width (default 1920)"
+        help="scale frames down to fit this pixel width (default 1920)"
     )
     parser.add_argument(
         "--height",
         type=int,
         default=1080,
-        help="web camera pixel height (default 1080)",
+        help="scale frames down to fit this pixel height (default 1080)",
     )
 
     parser.add_argument("--ipv", type=int, default=4, help="IP version (default=4)")
@@ -572,10 +2795,60 @@ def parseArgs():
         "--port", type=int, default=8080, help="HTTP bind port (default 8080)"
     )
     parser.add_argument(
-        "--encodewait", type=float, default=.5, help="seconds to pause between capturing encoded frames (default .5)"
+        "--server", type=str, default="threaded", choices=["threaded", "asyncio"], help="HTTP front-end - one thread per client or a single asyncio event loop (default threaded)"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=0, help="serve http from this many worker processes sharing the port, fed frames by one capture process (default 0 - disabled)"
+    )
+    parser.add_argument("--worker", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--snapshottag", type=str, help=argparse.SUPPRESS)
+    parser.add_argument(
+        "--processes", type=int, default=0, help="decode / rotate / overlay / encode frames in this many worker processes instead of threads (default 0 - disabled)"
+    )
+    parser.add_argument(
+        "--maxlag", type=float, default=10., help="disconnect stream sessions whose frames arrive more than this many seconds late (default 10 - 0 disables)"
+    )
+    parser.add_argument(
+        "--encodewait", type=float, default=.5, help="minimum seconds between published frames - frames arriving sooner are read and discarded (default .5)"
+    )
+    parser.add_argument(
+        "--streamwait", type=float, default=.01, help="not used - kept for compatibility"
+    )
+    parser.add_argument(
+        "--maxbackoff", type=float, default=60., help="longest wait in seconds between printer reconnect attempts (default 60)"
+    )
+    parser.add_argument(
+        "--motionthreshold", type=float, default=3., help="mean luma change (0-255) between frames that counts as motion / a changed frame (default 3)"
     )
     parser.add_argument(
-        "--streamwait", type=float, default=.01, help="not used - is set dynamically based on measured encoding fps"
+        "--dedupe", type=float, default=0., help="skip frames that did not change, publishing one every this many seconds as a keep-alive (default 0 - disabled)"
+    )
+    parser.add_argument(
+        "--record", type=str, metavar="DIRECTORY", help="record the printer's original jpegs into segments under DIRECTORY/NAME/ (default disabled)"
+    )
+    parser.add_argument(
+        "--segmentsize", type=float, default=512., help="start a new recording segment after this many megabytes (default 512)"
+    )
+    parser.add_argument(
+        "--segmentseconds", type=float, default=3600., help="start a new recording segment after this many seconds (default 3600)"
+    )
+    parser.add_argument(
+        "--timelapse", type=int, default=1, help="record only every Nth published frame - with --encodewait 10, --timelapse 6 records one frame a minute (default 1)"
+    )
+    parser.add_argument(
+        "--recordkeep", type=int, default=0, help="recording segments to keep per printer - older ones are deleted (default 0 - keep all)"
+    )
+    parser.add_argument(
+        "--export", type=str, nargs="?", const="/dev/shm", metavar="DIRECTORY", help="publish each printer's latest frames to a shared memory ring DIRECTORY/webcamd-NAME for local readers (default disabled, DIRECTORY defaults to /dev/shm)"
+    )
+    parser.add_argument(
+        "--exportsize", type=float, default=8., help="megabytes of frame data the shared memory ring holds (default 8)"
+    )
+    parser.add_argument(
+        "--idletimeout", type=float, default=30., help="with --ondemand, disconnect from a printer after this many seconds without clients (default 30)"
+    )
+    parser.add_argument(
+        "--dnsttl", type=float, default=300., help="seconds to cache reverse dns names of clients (default 300)"
     )
     parser.add_argument(
         "--rotate", type=int, default=-1, help="rotate captured image 1-359 in degrees - (default no rotation)"
@@ -583,17 +2856,52 @@ def parseArgs():
     parser.add_argument('--flashred', action='store_true', help="show a red dot in the upper right corner of the stream every other frame (default false)")
     parser.add_argument('--showfps', action='store_true', help="periodically show encoding / streaming frame rate (default false)")
     parser.add_argument('--loghttp', action='store_true', help="enable http server logging (default false)")
+    parser.add_argument('--motion', action='store_true', help="detect motion on the printer cameras and report it at /?events (default false)")
+    parser.add_argument('--exportsocket', action='store_true', help="with --export, announce each frame on the unix socket DIRECTORY/webcamd-NAME.sock (default false)")
+    parser.add_argument('--ondemand', action='store_true', help="only connect to printers while clients are watching (default false)")
+    parser.add_argument('--nodns', action='store_true', help="show client ip addresses instead of reverse dns names (default false)")
+    parser.add_argument('--passthrough', action='store_true', help="relay the printer's jpeg frames untouched when no rotation / fps overlay / flashred is requested - snapshots skip the watermark (default false)")
 
     myargs = parser.parse_args()
 
-# def exit_gracefully(signum, frame):
-#     global webserver
-
-#     if not webserver is None and webserver.isRunning():
-#         print(f"{datetime.datetime.now()}: web server shutting down", flush=True)
-#         webserver.shutdown()
-
-#     raise KeyboardInterrupt()
+    # --hostname / --password (served at / and /cam/default/) come first, then --printer, then --config
+    printers = []
+    if myargs.hostname is not None or myargs.password is not None:
+        if myargs.hostname is None or myargs.password is None:
+            parser.error("--hostname and --password must be specified together")
+        printers.append({"name": "default", "hostname": myargs.hostname, "password": myargs.password})
+
+    for printer in myargs.printer:
+        name, _, address = printer.partition("=")
+        hostname, _, password = address.rpartition(":")
+        if not name or not hostname or not password:
+            parser.error(f"invalid --printer '{printer}' - expected NAME=HOSTNAME:ACCESSCODE")
+        printers.append({"name": name, "hostname": hostname, "password": password})
+
+    if myargs.config is not None:
+        try:
+            with open(myargs.config) as config:
+                entries = json.load(config)
+            if isinstance(entries, dict): entries = entries["printers"]
+            for entry in entries:
+                printers.append({"name": str(entry["name"]), "hostname": entry["hostname"], "password": str(entry["password"]), "rotate": int(entry.get("rotate", myargs.rotate))})
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            parser.error(f"unable to load printers from {myargs.config}: {e}")
+
+    if myargs.timelapse < 1: parser.error("--timelapse must be at least 1")
+    if myargs.workers < 0: parser.error("--workers must not be negative")
+    # the capture process can't see the workers' clients
+    if myargs.workers > 0 and myargs.ondemand: parser.error("--ondemand can't be combined with --workers")
+    if myargs.segmentsize <= 0 or myargs.segmentseconds <= 0: parser.error("--segmentsize and --segmentseconds must be positive")
+
+    if len(printers) == 0:
+        parser.error("no printers configured - specify --hostname and --password, --printer or --config")
+
+    names = [printer["name"] for printer in printers]
+    if len(set(names)) != len(names):
+        parser.error(f"printer names must be unique: {', '.join(names)}")
+
+    myargs.printers = printers
 
 if __name__ == "__main__":
     main()